@@ -20,6 +20,8 @@ from database import ResultSummary
 from database.db_models import BraTSImage
 
 from .feature_extractor import FeatureExtractor
+from .feature_extractor import EXTRACT_BATCH_SIZE
+from .feature_extractor import TEMPLATE_CACHE_SIZE
 from .widget import MainWindow
 from .widget.contour_module.rasterise import make_masked_image
 from .widget.contour_module.structure import Structure
@@ -39,7 +41,6 @@ MAX_PAGES_PER_STAGE = 10
 BRUSH = 'BRUSH'
 LINE = 'LINE'
 
-TOPK_IMAGE = 200
 TOPK_PATIENT = 10
 DPI = 512
 
@@ -134,19 +135,44 @@ class AppController(object):
             code_root_dir_path=self.gl_config['mongodb']['code_root_dir_path'],
             model_name=self.app_state['model_name'],
             n_trees=self.gl_config['annoy']['n_trees'],
+            n_jobs=self.gl_config['annoy'].get('n_jobs', -1),
+            on_disk_build=self.gl_config['annoy'].get('on_disk_build', False),
+            background_rebuild=self.gl_config['annoy'].get('background_rebuild', True),
+            index_type=self.gl_config['annoy'].get('index_type', 'annoy'),
+            patient_aggregation=self.gl_config['annoy'].get('patient_aggregation'),
+            pq_n_subvectors=self.gl_config['annoy'].get('pq_n_subvectors', 64),
+            pq_use_opq=self.gl_config['annoy'].get('pq_use_opq', False),
+            pq_n_rerank=self.gl_config['annoy'].get('pq_n_rerank', 100),
+            projection_dim=self.gl_config['annoy'].get('projection_dim'),
+            projection_whiten=self.gl_config['annoy'].get('projection_whiten', False),
+            hnsw_m=self.gl_config['annoy'].get('hnsw_m', 16),
+            hnsw_ef_construction=self.gl_config['annoy'].get('hnsw_ef_construction', 200),
+            hnsw_ef_search=self.gl_config['annoy'].get('hnsw_ef_search', 100),
             vector_length=self.ds_config['models'][model_name]['vector_length'],
+            verify_code_files=self.gl_config['mongodb'].get('verify_code_files', False),
             alias=self.gl_config['mongodb']['alias'],
             host=self.gl_config['mongodb']['host']
         )
 
         network_config = self.ds_config['models'][model_name]['network_config']
         saved_model_path = self.ds_config['models'][model_name]['saved_model_path']
+        inference_model_path = self.ds_config['models'][model_name].get('inference_model_path')
 
         feature_extractor = FeatureExtractor(
             network_config=network_config,
             saved_model_path=saved_model_path,
+            inference_model_path=inference_model_path,
+            encoder_backend=self.gl_config.get('inference', {}).get('encoder_backend', 'eager'),
+            compiled_model_dir=self.ds_config['models'][model_name].get('compiled_model_dir'),
+            n_threads=self.gl_config.get('inference', {}).get('n_threads'),
+            n_interop_threads=self.gl_config.get('inference', {}).get('n_interop_threads'),
+            quantization=self.gl_config.get('inference', {}).get('quantization', 'none'),
+            template_cache_size=self.gl_config.get('inference', {}).get('template_cache_size', TEMPLATE_CACHE_SIZE),
         )
 
+        if self.gl_config.get('inference', {}).get('precompute_template_codes', False):
+            self.precompute_template_codes(feature_extractor)
+
         return database_manager, feature_extractor
 
     def register_widget(self, widget, key):
@@ -196,10 +222,40 @@ class AppController(object):
 
         return image
 
-    def get_template_image(self):
+    def get_template_slice_num(self):
         current_slice = self.QueryWidget.viewer_controller.state['slice']
         max_slice = self.QueryWidget.get_z_length() - 1
-        slice_num = max_slice - current_slice
+        return max_slice - current_slice
+
+    def get_template_key(self, slice_num):
+        return (self.ds_config['template']['patient_id'], int(slice_num))
+
+    def get_template_slice_nums(self):
+        patient_id = self.ds_config['template']['patient_id']
+        modality = self.ds_config['template']['modalities'][0]
+
+        file_paths = glob.glob(os.path.join(
+            self.ds_config['template']['slice_root_dir_path'],
+            patient_id,
+            patient_id + '_{}_*.npy'.format(modality),
+        ))
+
+        return sorted(int(os.path.splitext(p)[0][-4:]) for p in file_paths)
+
+    def precompute_template_codes(self, feature_extractor,
+                                  batch_size=EXTRACT_BATCH_SIZE):
+        slice_nums = self.get_template_slice_nums()
+
+        print('Encoding {} template slices.'.format(len(slice_nums)))
+        for start in range(0, len(slice_nums), batch_size):
+            batch_slice_nums = slice_nums[start:start + batch_size]
+            feature_extractor.encode_templates(
+                [self.get_template_image(n) for n in batch_slice_nums],
+                [self.get_template_key(n) for n in batch_slice_nums])
+
+    def get_template_image(self, slice_num=None):
+        if slice_num is None:
+            slice_num = self.get_template_slice_num()
 
         if self.app_state['dataset_type'] == MICCAI_BraTS:
             series = []
@@ -241,7 +297,8 @@ class AppController(object):
 
     def extract_query_vector(self):
         current_slice = self.QueryWidget.viewer_controller.state['slice']
-        template_image = self.get_template_image()
+        slice_num = self.get_template_slice_num()
+        template_image = self.get_template_image(slice_num)
 
         extent = self.QueryWidget.get_axial_extent()
         origin = self.QueryWidget.get_image_origin()
@@ -289,24 +346,14 @@ class AppController(object):
 
         sketch_image = self.concat_masked_image(masked_images)
 
+        # After the first search on a template slice its nac comes from
+        # the template cache, so only the sketch is encoded.
         q_eac, q_nac, q_aac = self.FeatureExtractor.extract_feature(
-            template_image, sketch_image)
+            template_image, sketch_image,
+            template_key=self.get_template_key(slice_num))
 
         return q_eac, q_nac, q_aac, template_image, sketch_image
 
-    def filter_by_patient(self, results):
-        patient_ids = []
-        extracted_results = []
-
-        for result in results:
-            if not result.patient_id in patient_ids:
-                patient_ids.append(result.patient_id)
-                extracted_results.append(result)
-
-        extracted_results = extracted_results[:TOPK_PATIENT]
-
-        return extracted_results
-
     def get_image(self, patient_id, slice_num):
         images = []
 
@@ -545,9 +592,10 @@ class SearchImageWorker(QThread):
     def run(self):
         q_eac, q_nac, q_aac, template_image, sketch_image = self.app_controller.extract_query_vector()
 
-        results = self.app_controller.DatabaseManager.query(
-            q_eac, topk=TOPK_IMAGE)
-        records = self.app_controller.filter_by_patient(results)
+        db_indices, _ = self.app_controller.DatabaseManager.query_distinct_patients(
+            q_eac, topk_patient=TOPK_PATIENT)
+        records = self.app_controller.DatabaseManager.get_images_by_db_indices(
+            db_indices)
 
         retrieved_images = []
         for record in records:
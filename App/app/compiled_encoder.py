@@ -0,0 +1,143 @@
+import os
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+ENCODER_BACKENDS = {'eager', 'torchscript', 'onnx'}
+IMAGE_SIZE = 256
+ONNX_OPSET_VERSION = 13
+PARITY_ATOL = 1e-4
+
+
+def set_num_threads(n_threads=None, n_interop_threads=None):
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+    if n_interop_threads is not None:
+        # The inter-op pool can only be sized once per process, before it
+        # is first used.
+        try:
+            torch.set_num_interop_threads(n_interop_threads)
+        except RuntimeError:
+            print('Inter-op threads were already set, keeping {}.'.format(
+                torch.get_num_interop_threads()))
+
+
+def get_compiled_model_path(compiled_model_dir, model_name, backend):
+    extension = '.onnx' if backend == 'onnx' else '.pt'
+    return os.path.join(str(compiled_model_dir), model_name + extension)
+
+
+def example_input(input_dim, image_size=IMAGE_SIZE, batch_size=1, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, input_dim, image_size, image_size,
+                       generator=generator)
+
+
+def compile_torchscript(model, example, path):
+    # Traced in eval mode (NormalEncoder then returns mu only) and frozen:
+    # the weights become constants and the constant conv/elementwise
+    # chains are folded. optimize_for_inference is not applied, as the
+    # GroupNorm between every conv forces MKLDNN layout conversions that
+    # make it slower than the frozen graph on CPU.
+    model.eval()
+
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+
+    torch.jit.save(traced, path)
+
+
+def export_onnx(model, example, path, opset_version=ONNX_OPSET_VERSION):
+    # ONNX Runtime applies its own graph fusions at session creation.
+    model.eval()
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, path,
+            input_names=['input'],
+            output_names=['output'],
+            opset_version=opset_version,
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+        )
+
+
+class OnnxEncoder(object):
+
+    def __init__(self, path, n_threads=None, n_interop_threads=None):
+        try:
+            assert onnxruntime is not None
+        except Exception:
+            raise Exception('onnxruntime is required for the onnx encoders.')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+
+        if n_interop_threads is not None:
+            options.inter_op_num_threads = n_interop_threads
+
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        output = self.session.run(
+            None, {self.input_name: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def compile_encoder(model, example, path, backend):
+    assert backend in ENCODER_BACKENDS - {'eager'}
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if backend == 'torchscript':
+        compile_torchscript(model, example, path)
+
+    else:
+        export_onnx(model, example, path)
+
+
+def load_compiled_encoder(path, backend, n_threads=None,
+                          n_interop_threads=None):
+    if backend == 'torchscript':
+        model = torch.jit.load(str(path), map_location=torch.device('cpu'))
+        return model.eval()
+
+    return OnnxEncoder(path, n_threads=n_threads,
+                       n_interop_threads=n_interop_threads)
+
+
+def check_parity(eager_model, compiled_model, examples, atol=PARITY_ATOL):
+    eager_model.eval()
+    compiled_model.eval()
+
+    max_abs_diff = 0.0
+    max_rel_diff = 0.0
+
+    with torch.no_grad():
+        for example in examples:
+            expected = eager_model(example)
+            output = compiled_model(example)
+
+            diff = (output - expected).abs()
+            max_abs_diff = max(max_abs_diff, float(diff.max()))
+            max_rel_diff = max(max_rel_diff, float(
+                diff.max() / expected.abs().max().clamp(min=1e-12)))
+
+    return {
+        'max_abs_diff': max_abs_diff,
+        'max_rel_diff': max_rel_diff,
+        'passed': max_abs_diff <= atol,
+    }
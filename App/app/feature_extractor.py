@@ -1,89 +1,220 @@
+import os
 import torch
+import numpy as np
+from collections import OrderedDict
 
 from networks import NormalEncoder
 from networks import Encoder
-from networks import Decoder
+from .compiled_encoder import ENCODER_BACKENDS
+from .compiled_encoder import set_num_threads
+from .compiled_encoder import get_compiled_model_path
+from .compiled_encoder import load_compiled_encoder
+from .quantization import QUANTIZATION_MODES
+from .quantization import get_quantized_model_path
+from .quantization import load_int8_encoder
+from .quantization import load_fp16_state_dict
 
 
-def model_state_dict(state_dict, model_name):
-    new_state_dict = {}
+INFERENCE_MODEL_NAMES = ('nEncoder', 'lEncoder', 'aEncoder')
+INFERENCE_MODEL_VERSION = 1
+EXTRACT_BATCH_SIZE = 16
+TEMPLATE_CACHE_SIZE = 256
+
+
+def split_state_dict(state_dict, model_names):
+    # Single pass over the checkpoint keys ('nEncoder.blocks.0.weight')
+    # instead of one substring scan per sub-model.
+    state_dicts = {model_name: {} for model_name in model_names}
+
     for key, value in state_dict.items():
-        if model_name in key:
-            new_key = key[len(model_name) + 1:]
-            new_state_dict[new_key] = value
-    return new_state_dict
+        model_name, _, new_key = key.partition('.')
+
+        if model_name in state_dicts:
+            state_dicts[model_name][new_key] = value
+
+    return state_dicts
+
+
+def load_checkpoint_state_dict(saved_model_path):
+    return torch.load(saved_model_path,
+                      map_location=torch.device('cpu'))['state_dict']
+
+
+def build_encoder(config):
+    if config.get('use_vae', False):
+        return NormalEncoder(
+            input_dim=config['input_dim'],
+            emb_dim=config['emb_dim'],
+            filters=config['filters']
+        )
+
+    return Encoder(
+        input_dim=config['input_dim'],
+        emb_dim=config['emb_dim'],
+        filters=config['filters']
+    )
+
+
+def export_inference_model(saved_model_path, inference_model_path,
+                           network_config):
+    # Writes the encoder weights only; the optimizer state, the decoders
+    # and the discriminators of the training checkpoint are dropped.
+    state_dicts = split_state_dict(
+        load_checkpoint_state_dict(saved_model_path), INFERENCE_MODEL_NAMES)
+
+    for model_name in INFERENCE_MODEL_NAMES:
+        try:
+            assert len(state_dicts[model_name]) > 0
+        except Exception:
+            raise Exception('{} is missing in {}.'.format(
+                model_name, saved_model_path))
+
+        state_dicts[model_name] = {
+            key: value.detach().clone()
+            for key, value in state_dicts[model_name].items()
+        }
+
+    bundle = {
+        'version': INFERENCE_MODEL_VERSION,
+        'source': os.path.basename(str(saved_model_path)),
+        'network_config': {
+            model_name: network_config[model_name]
+            for model_name in INFERENCE_MODEL_NAMES
+        },
+        'state_dicts': state_dicts,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(inference_model_path)),
+                exist_ok=True)
+    tmp_path = str(inference_model_path) + '.tmp'
+    torch.save(bundle, tmp_path)
+    os.replace(tmp_path, inference_model_path)
+
+    return bundle
+
+
+def load_inference_model(inference_model_path, network_config):
+    bundle = torch.load(inference_model_path,
+                        map_location=torch.device('cpu'))
+
+    try:
+        assert bundle['version'] == INFERENCE_MODEL_VERSION
+        assert all(
+            bundle['network_config'][model_name] == network_config[model_name]
+            for model_name in INFERENCE_MODEL_NAMES)
+    except Exception:
+        raise Exception('Inference model {} does not match the network '
+                        'config, export it again.'.format(inference_model_path))
+
+    return bundle['state_dicts']
 
 
 class FeatureExtractor(object):
 
-    def __init__(self, network_config, saved_model_path):
+    def __init__(self,
+                 network_config,
+                 saved_model_path,
+                 inference_model_path=None,
+                 encoder_backend='eager',
+                 compiled_model_dir=None,
+                 n_threads=None,
+                 n_interop_threads=None,
+                 quantization='none',
+                 template_cache_size=TEMPLATE_CACHE_SIZE):
         self.network_config = network_config
         self.saved_model_path = saved_model_path
+        self.inference_model_path = inference_model_path
+        self.encoder_backend = encoder_backend
+        self.compiled_model_dir = compiled_model_dir
+        self.n_threads = n_threads
+        self.n_interop_threads = n_interop_threads
+        self.quantization = quantization
+
+        assert self.encoder_backend in ENCODER_BACKENDS
+        assert self.quantization in QUANTIZATION_MODES
+
+        # LRU cache of the nac of template slices, keyed by e.g.
+        # (patient_id, slice_num). The template is fixed and only the
+        # sketch changes between searches.
+        self.template_cache_size = template_cache_size
+        self.template_codes = OrderedDict()
 
         self.init_models()
 
     def init_models(self):
-        state_dict = torch.load(self.saved_model_path,
-                                map_location=torch.device('cpu'))['state_dict']
+        set_num_threads(self.n_threads, self.n_interop_threads)
+
+        eager_model_names = []
+        for model_name in INFERENCE_MODEL_NAMES:
+            model = self.load_optimized_encoder(model_name)
+
+            if model is None:
+                eager_model_names.append(model_name)
+
+            else:
+                setattr(self, model_name, model)
 
-        if self.network_config['nEncoder']['use_vae']:
-            self.nEncoder = NormalEncoder(
-                input_dim=self.network_config['nEncoder']['input_dim'],
-                emb_dim=self.network_config['nEncoder']['emb_dim'],
-                filters=self.network_config['nEncoder']['filters']
-            )
+        if len(eager_model_names) > 0:
+            self.init_eager_models(eager_model_names)
 
+        # The encoders are only ever used for inference.
+        for model_name in INFERENCE_MODEL_NAMES:
+            getattr(self, model_name).eval()
+
+    def load_optimized_encoder(self, model_name):
+        # Quantized encoders take precedence over the compiled ones. None
+        # means the float32 eager encoder is used.
+        if self.quantization != 'none':
+            mode = self.quantization
+        elif self.encoder_backend != 'eager':
+            mode = self.encoder_backend
         else:
-            self.nEncoder = Encoder(
-                input_dim=self.network_config['nEncoder']['input_dim'],
-                emb_dim=self.network_config['nEncoder']['emb_dim'],
-                filters=self.network_config['nEncoder']['filters']
-            )
-
-        self.nEncoder.load_state_dict(model_state_dict(state_dict, 'nEncoder'))
-
-        self.lEncoder = Encoder(
-            input_dim=self.network_config['lEncoder']['input_dim'],
-            emb_dim=self.network_config['lEncoder']['emb_dim'],
-            filters=self.network_config['lEncoder']['filters']
-        )
+            return None
+
+        if self.compiled_model_dir is not None:
+            if self.quantization != 'none':
+                path = get_quantized_model_path(
+                    self.compiled_model_dir, model_name, self.quantization)
+            else:
+                path = get_compiled_model_path(
+                    self.compiled_model_dir, model_name, self.encoder_backend)
+
+            if os.path.exists(path):
+                if self.quantization == 'int8':
+                    return load_int8_encoder(path)
+
+                elif self.quantization == 'fp16_weights':
+                    model = build_encoder(self.network_config[model_name])
+                    model.load_state_dict(load_fp16_state_dict(path))
+                    return model
+
+                return load_compiled_encoder(
+                    path, self.encoder_backend,
+                    n_threads=self.n_threads,
+                    n_interop_threads=self.n_interop_threads)
+
+        print('{} {} encoder is missing, running it eagerly.'.format(
+            mode, model_name))
+        return None
 
-        self.lEncoder.load_state_dict(model_state_dict(state_dict, 'lEncoder'))
+    def init_eager_models(self, model_names):
+        if self.inference_model_path is not None and \
+                os.path.exists(self.inference_model_path):
+            state_dicts = load_inference_model(
+                self.inference_model_path, self.network_config)
 
-        if self.network_config['aEncoder']['use_vae']:
-            self.aEncoder = NormalEncoder(
-                input_dim=self.network_config['aEncoder']['input_dim'],
-                emb_dim=self.network_config['aEncoder']['emb_dim'],
-                filters=self.network_config['aEncoder']['filters']
-            )
         else:
-            self.aEncoder = Encoder(
-                input_dim=self.network_config['aEncoder']['input_dim'],
-                emb_dim=self.network_config['aEncoder']['emb_dim'],
-                filters=self.network_config['aEncoder']['filters']
-            )
-
-        self.aEncoder.load_state_dict(model_state_dict(state_dict, 'aEncoder'))
-
-        if 'iDecoder' in self.network_config.keys():
-            self.iDecoder = Decoder(
-                output_dim=self.network_config['iDecoder']['output_dim'],
-                emb_dim=self.network_config['iDecoder']['emb_dim'],
-                filters=self.network_config['iDecoder']['filters'],
-            )
-
-            self.iDecoder.load_state_dict(
-                model_state_dict(state_dict, 'iDecoder'))
-
-        if 'lDecoder' in self.network_config.keys():
-            self.lDecoder = Decoder(
-                output_dim=self.network_config['lDecoder']['output_dim'],
-                emb_dim=self.network_config['lDecoder']['emb_dim'],
-                filters=self.network_config['lDecoder']['filters'],
-            )
-
-            self.lDecoder.load_state_dict(
-                model_state_dict(state_dict, 'lDecoder'))
+            print('Loading the full checkpoint {}; export an inference model '
+                  'with export_inference_model.py for a faster start.'.format(
+                      self.saved_model_path))
+            state_dicts = split_state_dict(load_checkpoint_state_dict(
+                self.saved_model_path), INFERENCE_MODEL_NAMES)
+
+        # Only the encoders are needed to compute the query codes.
+        for model_name in model_names:
+            model = build_encoder(self.network_config[model_name])
+            model.load_state_dict(state_dicts[model_name])
+            setattr(self, model_name, model)
 
     def preprocess(self, image, label=None):
         image = torch.from_numpy(image).float().unsqueeze(0)
@@ -91,33 +222,110 @@ class FeatureExtractor(object):
             label = torch.from_numpy(label).float().unsqueeze(0).unsqueeze(0)
         return image, label
 
-    def to_code(self, tensor):
-        return tensor.squeeze(0).cpu().detach().numpy().flatten()
+    def stack_batch(self, arrays):
+        return torch.from_numpy(np.stack(arrays).astype(np.float32, copy=False))
 
-    def extract_feature(self, template_image, sketch_image):
-        with torch.no_grad():
-            image, label = self.preprocess(template_image, sketch_image)
+    def preprocess_batch(self, images, labels=None):
+        images = self.stack_batch(images)
+        if labels is not None:
+            labels = self.stack_batch(labels).unsqueeze(1)
+        return images, labels
 
-            self.nEncoder.eval()
-            self.lEncoder.eval()
+    def to_codes(self, tensor):
+        return tensor.reshape(len(tensor), -1).cpu().numpy()
 
-            nac = self.to_code(self.nEncoder(image))
-            aac = self.to_code(self.lEncoder(label))
+    def cache_template_code(self, template_key, nac):
+        if template_key is None or self.template_cache_size == 0:
+            return
 
-            eac = (nac + aac)
+        self.template_codes[template_key] = nac
+        self.template_codes.move_to_end(template_key)
 
-        return eac, nac, aac
+        while len(self.template_codes) > self.template_cache_size:
+            self.template_codes.popitem(last=False)
 
-    def extract_anatomy_code(self, input_image):
-        with torch.no_grad():
-            image, label = self.preprocess(input_image)
+    def encode_templates(self,
+                         template_images,
+                         template_keys=None,
+                         batch_size=EXTRACT_BATCH_SIZE):
+        # nac of the template slices; only the ones missing from the cache
+        # go through the nEncoder.
+        if template_keys is None:
+            template_keys = [None] * len(template_images)
+
+        assert len(template_images) == len(template_keys)
+
+        nacs = [None] * len(template_images)
+        for i, template_key in enumerate(template_keys):
+            if template_key is not None and \
+                    template_key in self.template_codes:
+                self.template_codes.move_to_end(template_key)
+                nacs[i] = self.template_codes[template_key]
+
+        missing = [i for i, nac in enumerate(nacs) if nac is None]
 
-            self.nEncoder.eval()
-            self.aEncoder.eval()
+        with torch.inference_mode():
+            for start in range(0, len(missing), batch_size):
+                rows = missing[start:start + batch_size]
+                images, _ = self.preprocess_batch(
+                    [template_images[i] for i in rows])
 
-            nac = self.to_code(self.nEncoder(image))
-            aac = self.to_code(self.aEncoder(image))
+                for i, nac in zip(rows, self.to_codes(self.nEncoder(images))):
+                    nacs[i] = nac.copy()
+                    self.cache_template_code(template_keys[i], nacs[i])
 
-            eac = (nac + aac)
+        return np.stack(nacs)
+
+    def extract_features_batch(self,
+                               template_images,
+                               sketch_images,
+                               batch_size=EXTRACT_BATCH_SIZE,
+                               template_keys=None):
+        # Returns (n, code_length) arrays; the pairs are encoded
+        # batch_size at a time to bound the activation memory. Templates
+        # with a key are looked up in the template cache first.
+        assert len(template_images) == len(sketch_images)
+
+        nac = self.encode_templates(template_images, template_keys,
+                                    batch_size=batch_size)
+
+        aacs = []
+        with torch.inference_mode():
+            for start in range(0, len(sketch_images), batch_size):
+                labels = self.stack_batch(
+                    sketch_images[start:start + batch_size]).unsqueeze(1)
+
+                aacs.append(self.to_codes(self.lEncoder(labels)))
+
+        aac = np.concatenate(aacs)
+        eac = (nac + aac)
 
         return eac, nac, aac
+
+    def extract_anatomy_codes_batch(self, input_images,
+                                    batch_size=EXTRACT_BATCH_SIZE):
+        nacs = []
+        aacs = []
+        with torch.inference_mode():
+            for start in range(0, len(input_images), batch_size):
+                images, _ = self.preprocess_batch(
+                    input_images[start:start + batch_size])
+
+                nacs.append(self.to_codes(self.nEncoder(images)))
+                aacs.append(self.to_codes(self.aEncoder(images)))
+
+        nac = np.concatenate(nacs)
+        aac = np.concatenate(aacs)
+        eac = (nac + aac)
+
+        return eac, nac, aac
+
+    def extract_feature(self, template_image, sketch_image,
+                        template_key=None):
+        eac, nac, aac = self.extract_features_batch(
+            [template_image], [sketch_image], template_keys=[template_key])
+        return eac[0], nac[0], aac[0]
+
+    def extract_anatomy_code(self, input_image):
+        eac, nac, aac = self.extract_anatomy_codes_batch([input_image])
+        return eac[0], nac[0], aac[0]
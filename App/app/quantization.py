@@ -0,0 +1,177 @@
+import os
+import copy
+import glob
+import time
+import numpy as np
+import torch
+from torch.quantization import get_default_qconfig
+from torch.quantization.quantize_fx import prepare_fx
+from torch.quantization.quantize_fx import convert_fx
+
+from database.index_backends import ExactIndex
+from .compiled_encoder import compile_torchscript
+
+
+QUANTIZATION_MODES = {'none', 'int8', 'fp16_weights'}
+QUANTIZED_ENGINE = 'fbgemm'
+CODE_NAMES = ('eac', 'nac', 'aac')
+
+
+def get_quantized_model_path(compiled_model_dir, model_name, quantization):
+    return os.path.join(str(compiled_model_dir),
+                        model_name + '-' + quantization + '.pt')
+
+
+def quantize_int8(model, calibration_inputs, engine=QUANTIZED_ENGINE):
+    # Static post-training quantization: convolutions and residual adds run
+    # in int8 with per-channel weight scales and activation ranges observed
+    # on the calibration inputs. GroupNorm has no int8 kernel and runs in
+    # float between them.
+    torch.backends.quantized.engine = engine
+
+    prepared = prepare_fx(copy.deepcopy(model).eval(),
+                          {'': get_default_qconfig(engine)})
+
+    with torch.no_grad():
+        for calibration_input in calibration_inputs:
+            prepared(calibration_input)
+
+    return convert_fx(prepared)
+
+
+def save_int8_encoder(model, example, path):
+    # Saved as TorchScript so it loads without the FX tooling.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    compile_torchscript(model, example, path)
+
+
+def load_int8_encoder(path, engine=QUANTIZED_ENGINE):
+    torch.backends.quantized.engine = engine
+    model = torch.jit.load(str(path), map_location=torch.device('cpu'))
+    return model.eval()
+
+
+def save_fp16_state_dict(model, path):
+    # Storage-only compression: the CPU kernels of torch have no half
+    # precision convolutions, so the weights are cast back to float32 by
+    # load_state_dict and inference is neither faster nor smaller in RAM.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.save({
+        key: value.half() if value.is_floating_point() else value
+        for key, value in model.state_dict().items()
+    }, path)
+
+
+def load_fp16_state_dict(path):
+    return torch.load(str(path), map_location=torch.device('cpu'))
+
+
+def sample_slices(slice_root_dir_path,
+                  modalities,
+                  n_samples,
+                  label_modality='seg',
+                  seed=0):
+    # (template_image, sketch_image) pairs from the preprocessed slices,
+    # with the label map standing in for the sketch.
+    slice_paths = sorted(glob.glob(os.path.join(
+        str(slice_root_dir_path), '*', '*_' + label_modality + '_*.npy')))
+
+    try:
+        assert len(slice_paths) > 0
+    except Exception:
+        raise Exception('No slices were found in {}.'.format(
+            slice_root_dir_path))
+
+    rng = np.random.RandomState(seed)
+    rows = rng.choice(len(slice_paths), size=min(n_samples, len(slice_paths)),
+                      replace=False)
+
+    samples = []
+    for row in rows:
+        label_path = slice_paths[row]
+        template_image = np.stack([
+            np.load(label_path.replace(
+                '_' + label_modality + '_', '_' + modality + '_'))
+            for modality in modalities
+        ]).astype(np.float32)
+
+        samples.append((template_image,
+                        np.load(label_path).astype(np.float32)))
+
+    return samples
+
+
+def get_calibration_inputs(feature_extractor, samples):
+    # Inputs of every encoder, preprocessed like in extract_feature.
+    inputs = {'nEncoder': [], 'lEncoder': [], 'aEncoder': []}
+
+    for template_image, sketch_image in samples:
+        image, label = feature_extractor.preprocess(template_image,
+                                                    sketch_image)
+        inputs['nEncoder'].append(image)
+        inputs['aEncoder'].append(image)
+        inputs['lEncoder'].append(label)
+
+    return inputs
+
+
+def evaluate_quantization(reference_extractor,
+                          quantized_extractor,
+                          samples,
+                          reference_matrix=None,
+                          topk=10,
+                          measure_latency=True):
+    # L2 drift of the query codes against the float32 encoders and, given
+    # the eac matrix of the database, the overlap of their top-k results.
+    # Latencies are left out for modes that do not change the computation.
+    codes = {'reference': {c: [] for c in CODE_NAMES},
+             'quantized': {c: [] for c in CODE_NAMES}}
+    latencies = {'reference': [], 'quantized': []}
+
+    for template_image, sketch_image in samples:
+        for name, feature_extractor in (('reference', reference_extractor),
+                                        ('quantized', quantized_extractor)):
+            start = time.perf_counter()
+            sample_codes = feature_extractor.extract_feature(
+                template_image, sketch_image)
+            latencies[name].append(time.perf_counter() - start)
+
+            for code_name, code in zip(CODE_NAMES, sample_codes):
+                codes[name][code_name].append(code)
+
+    report = {'n_samples': len(samples), 'drift': {}}
+    for code_name in CODE_NAMES:
+        reference = np.stack(codes['reference'][code_name])
+        quantized = np.stack(codes['quantized'][code_name])
+
+        l2 = np.linalg.norm(quantized - reference, axis=1)
+        norms = np.maximum(np.linalg.norm(reference, axis=1), 1e-12)
+
+        report['drift'][code_name] = {
+            'mean_l2': float(l2.mean()),
+            'max_l2': float(l2.max()),
+            'mean_relative_l2': float(np.mean(l2 / norms)),
+        }
+
+    if measure_latency:
+        report['latency_ms'] = {
+            name: 1e3 * float(np.mean(values))
+            for name, values in latencies.items()
+        }
+
+    if reference_matrix is not None:
+        exact_index = ExactIndex(reference_matrix.shape[1])
+        exact_index.build(np.arange(len(reference_matrix)), reference_matrix)
+
+        reference_ids, _ = exact_index.query_batch(
+            np.stack(codes['reference']['eac']), topk)
+        quantized_ids, _ = exact_index.query_batch(
+            np.stack(codes['quantized']['eac']), topk)
+
+        report['topk'] = topk
+        report['topk_overlap'] = float(np.mean([
+            len(set(r.tolist()) & set(q.tolist())) / topk
+            for r, q in zip(reference_ids, quantized_ids)
+        ]))
+
+    return report
@@ -0,0 +1,151 @@
+import os
+import json
+import pathlib
+import argparse
+import platform
+import datetime
+import numpy as np
+
+from database.benchmark import run_benchmark
+from database.benchmark import load_code_matrix
+from database.benchmark import synthetic_codes
+from database.code_store import CODE_STORE_DIR_NAME
+from utils import read_yaml
+from utils import replace_env_variables_in_config
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+def get_settings(args):
+    settings = []
+
+    if 'exact' in args.index_types:
+        settings.append({'index_type': 'exact'})
+
+    if 'annoy' in args.index_types:
+        for n_trees in args.n_trees:
+            settings.append({
+                'index_type': 'annoy',
+                'build_params': {'n_trees': n_trees},
+                'query_params': [{'search_k': k} for k in args.search_k],
+            })
+
+    if 'hnsw' in args.index_types:
+        for m in args.hnsw_m:
+            settings.append({
+                'index_type': 'hnsw',
+                'build_params': {'m': m,
+                                 'ef_construction': args.hnsw_ef_construction},
+                'query_params': [{'ef_search': ef} for ef in args.ef_search],
+            })
+
+    if 'pq' in args.index_types:
+        for n_subvectors in args.pq_n_subvectors:
+            settings.append({
+                'index_type': 'pq',
+                'build_params': {'n_subvectors': n_subvectors,
+                                 'use_opq': args.pq_use_opq},
+                'query_params': [{'n_rerank': n} for n in args.n_rerank],
+            })
+
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Latency and recall benchmark of the search indexes.')
+    parser.add_argument('--dataset_type', default='MICCAI_BraTS')
+    parser.add_argument('--model_name', default=None,
+                        help='defaults to the first model in config.yaml')
+    parser.add_argument('--code_store', default=None,
+                        help='code store directory, defaults to the one of '
+                             'the model; synthetic vectors are used when it '
+                             'does not exist')
+    parser.add_argument('--code_type', default='eac')
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--n_rows', type=int, default=20000)
+    parser.add_argument('--vector_length', type=int, default=2048)
+    parser.add_argument('--n_queries', type=int, default=200)
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--index_types', nargs='*',
+                        default=['exact', 'annoy', 'hnsw', 'pq'])
+    parser.add_argument('--n_trees', type=int, nargs='*', default=[10, 50])
+    parser.add_argument('--search_k', type=int, nargs='*',
+                        default=[-1, 10000])
+    parser.add_argument('--hnsw_m', type=int, nargs='*', default=[16])
+    parser.add_argument('--hnsw_ef_construction', type=int, default=200)
+    parser.add_argument('--ef_search', type=int, nargs='*',
+                        default=[50, 100, 200])
+    parser.add_argument('--pq_n_subvectors', type=int, nargs='*', default=[64])
+    parser.add_argument('--pq_use_opq', action='store_true')
+    parser.add_argument('--n_rerank', type=int, nargs='*', default=[0, 100])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_index.json')
+    args = parser.parse_args()
+
+    matrix = None
+    data = {'source': 'synthetic'}
+
+    if not args.synthetic:
+        store_dir_path = args.code_store
+
+        if store_dir_path is None and os.path.exists('config.yaml'):
+            config = read_yaml('config.yaml')
+            replace_env_variables_in_config(config)
+
+            ds_config = config['dataset_types'][args.dataset_type]
+            model_name = args.model_name or \
+                list(ds_config['models'].keys())[0]
+
+            store_dir_path = pathlib.Path(
+                config['mongodb']['code_root_dir_path']) \
+                / ds_config['dataset_name'] \
+                / model_name \
+                / CODE_STORE_DIR_NAME
+
+        if store_dir_path is not None and os.path.exists(store_dir_path):
+            matrix = load_code_matrix(store_dir_path, args.code_type)
+
+        if matrix is not None:
+            data = {'source': 'code_store',
+                    'path': str(store_dir_path),
+                    'code_type': args.code_type}
+
+    if matrix is None:
+        print('No code store was found, using {} synthetic vectors.'.format(
+            args.n_rows))
+        matrix = synthetic_codes(args.n_rows, args.vector_length,
+                                 seed=args.seed)
+
+    report = run_benchmark(matrix, get_settings(args),
+                           n_queries=args.n_queries,
+                           topk=args.topk,
+                           seed=args.seed)
+
+    report['data'] = data
+    report['created_at'] = datetime.datetime.now().isoformat()
+    report['platform'] = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'n_cpus': os.cpu_count(),
+    }
+
+    for result in report['results']:
+        print('{} {} {}: recall@{} {:.3f}, p50 {:.2f} ms, p99 {:.2f} ms, '
+              '{:.0f} qps, build {:.1f}s, {:.1f} MB'.format(
+                  result['index_type'],
+                  result['build_params'],
+                  result['query_params'],
+                  args.topk,
+                  result['recall_at_k'],
+                  result['latency_ms']['p50'],
+                  result['latency_ms']['p99'],
+                  result['qps'],
+                  result['build_time_s'],
+                  result['index_bytes'] / 2 ** 20))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print('Saved the benchmark to {}.'.format(args.output))
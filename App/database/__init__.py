@@ -1,3 +1,7 @@
 from .data_manager import DatabaseManager
+from .data_manager import SliceHit
+from .code_store import CodeStore
+from .slice_table import SliceTable
+from .retrieved_writer import RetrievedWriter
 from .db_models import User
 from .db_models import ResultSummary
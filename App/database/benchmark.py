@@ -0,0 +1,179 @@
+import os
+import glob
+import time
+import pathlib
+import tempfile
+import numpy as np
+from tqdm import tqdm
+
+from .code_store import CodeStore
+from .index_backends import ExactIndex
+from .index_backends import AnnoyBackend
+from .index_backends import HNSWBackend
+from .pq_index import PQIndex
+
+
+BENCHMARK_BACKENDS = {
+    'exact': ExactIndex,
+    'annoy': AnnoyBackend,
+    'hnsw': HNSWBackend,
+    'pq': PQIndex,
+}
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def synthetic_codes(n_rows, vector_length, n_clusters=64, spread=1.0, seed=0):
+    # Gaussian clusters, so that the approximate indexes see some
+    # neighbourhood structure instead of uniform noise.
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(n_clusters, vector_length).astype(np.float32)
+    labels = rng.randint(n_clusters, size=n_rows)
+
+    matrix = centers[labels]
+    matrix += spread * rng.randn(n_rows, vector_length).astype(np.float32)
+
+    return matrix
+
+
+def load_code_matrix(store_dir_path, code_type='eac'):
+    # Packed code store first, then the raw shards written by
+    # DecompTrainerBase.test_step. None when neither exists.
+    store_dir_path = pathlib.Path(store_dir_path)
+
+    if CodeStore.exists(store_dir_path):
+        return CodeStore(store_dir_path).get_matrix(code_type)
+
+    if CodeStore.has_shards(store_dir_path):
+        shard_paths = sorted(glob.glob(
+            str(store_dir_path / (code_type + '-*.npy'))))
+        return np.concatenate([
+            np.load(shard_path, mmap_mode='r') for shard_path in shard_paths])
+
+    return None
+
+
+def split_queries(n_rows, n_queries, seed=0):
+    # Query rows are held out of the index, so no query finds itself.
+    rng = np.random.RandomState(seed)
+    query_rows = np.sort(rng.choice(n_rows, size=min(n_queries, n_rows - 1),
+                                    replace=False))
+
+    reference_rows = np.ones(n_rows, dtype=bool)
+    reference_rows[query_rows] = False
+
+    return np.flatnonzero(reference_rows), query_rows
+
+
+def latency_stats(latencies):
+    latencies = 1e3 * np.asarray(latencies, dtype=np.float64)
+
+    stats = {'mean': float(latencies.mean())}
+    for percentile in LATENCY_PERCENTILES:
+        stats['p' + str(percentile)] = \
+            float(np.percentile(latencies, percentile))
+
+    return stats
+
+
+def recall_at_k(ids, exact_ids):
+    recalls = [
+        len(set(q_ids[q_ids >= 0].tolist()) & set(q_exact_ids.tolist()))
+        / len(q_exact_ids)
+        for q_ids, q_exact_ids in zip(ids, exact_ids)
+    ]
+    return float(np.mean(recalls))
+
+
+def measure_queries(index, queries, topk, query_params):
+    # Warm-up query, then one timed query at a time for the latency
+    # distribution and a timed query_batch for the throughput.
+    index.query(queries[0], topk, **query_params)
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.query(query, topk, **query_params)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    ids, _ = index.query_batch(queries, topk, **query_params)
+    batch_time = time.perf_counter() - start
+
+    return ids, latencies, batch_time
+
+
+def get_index_size(index, path):
+    # Size of the saved file; for pq this is the compressed codes only, the
+    # rerank rows are read from the code store.
+    if path is not None and os.path.exists(path):
+        return os.path.getsize(path)
+
+    # Indexes that are never saved are held in memory as a whole.
+    return int(index.matrix.nbytes + index.ids.nbytes)
+
+
+def run_benchmark(matrix, settings, n_queries=200, topk=10, seed=0,
+                  work_dir_path=None):
+    # settings is a list of
+    #   {'index_type': ..., 'build_params': {...}, 'query_params': [{...}]}
+    # and every query_params entry gives one result row.
+    reference_rows, query_rows = split_queries(len(matrix), n_queries, seed)
+
+    reference_matrix = np.asarray(matrix[reference_rows], dtype=np.float32)
+    queries = np.asarray(matrix[query_rows], dtype=np.float32)
+    vector_length = reference_matrix.shape[1]
+
+    print('Computing exact neighbours of {} queries over {} vectors.'.format(
+        len(queries), len(reference_matrix)))
+    exact_index = ExactIndex(vector_length)
+    exact_index.build(reference_rows, reference_matrix)
+    exact_ids, _ = exact_index.query_batch(queries, topk)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir_path) as tmp_dir_path:
+        for setting in settings:
+            index_type = setting['index_type']
+            build_params = setting.get('build_params', {})
+
+            index = BENCHMARK_BACKENDS[index_type](
+                vector_length, **build_params)
+
+            file_name = index.get_file_name('benchmark')
+            index_path = None if file_name is None \
+                else os.path.join(tmp_dir_path, file_name)
+
+            print('Building {} index with {}.'.format(index_type, build_params))
+            start = time.perf_counter()
+            index.build(reference_rows, reference_matrix, path=index_path)
+            build_time = time.perf_counter() - start
+
+            if index_path is not None:
+                index.save(index_path)
+
+            index_size = get_index_size(index, index_path)
+
+            for query_params in tqdm(setting.get('query_params', [{}])):
+                ids, latencies, batch_time = measure_queries(
+                    index, queries, topk, query_params)
+
+                results.append({
+                    'index_type': index_type,
+                    'build_params': build_params,
+                    'query_params': query_params,
+                    'build_time_s': build_time,
+                    'index_bytes': index_size,
+                    'recall_at_k': recall_at_k(ids, exact_ids),
+                    'latency_ms': latency_stats(latencies),
+                    'qps': len(queries) / batch_time,
+                    'qps_single': len(queries) / float(np.sum(latencies)),
+                })
+
+            index.unload()
+
+    return {
+        'n_items': len(reference_matrix),
+        'n_queries': len(queries),
+        'vector_length': vector_length,
+        'topk': topk,
+        'results': results,
+    }
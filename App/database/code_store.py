@@ -0,0 +1,374 @@
+import io
+import os
+import glob
+import json
+import hashlib
+import pathlib
+import numpy as np
+from tqdm import tqdm
+
+
+CODE_TYPES = ('eac', 'nac', 'aac')
+CODE_STORE_DIR_NAME = 'code_store'
+MANIFEST_NAME = 'manifest.json'
+FINGERPRINT_BLOCK_SIZE = 4096
+
+
+def slice_key(patient_id, slice_num):
+    return patient_id + '_' + str(int(slice_num)).zfill(4)
+
+
+def append_npy_rows(npy_path, rows, block_size=FINGERPRINT_BLOCK_SIZE):
+    # Grows a C-ordered .npy file in place: the rows are written at the end
+    # first and the header is then rewritten with the new shape. The header
+    # is padded, so it keeps its length unless the shape outgrows the
+    # padding, in which case the file is rewritten once.
+    with open(npy_path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            write_header = np.lib.format.write_array_header_1_0
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            write_header = np.lib.format.write_array_header_2_0
+
+        header_length = f.tell()
+
+        assert not fortran_order
+        assert tuple(shape[1:]) == tuple(rows.shape[1:])
+
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        new_shape = (shape[0] + len(rows),) + tuple(shape[1:])
+
+        header = io.BytesIO()
+        write_header(header, {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': new_shape,
+        })
+
+        if len(header.getvalue()) == header_length:
+            f.seek(header_length + shape[0] * dtype.itemsize
+                   * int(np.prod(shape[1:])))
+            f.write(rows.tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    old_matrix = np.load(npy_path, mmap_mode='r')
+    tmp_path = pathlib.Path(str(npy_path) + '.tmp')
+    new_matrix = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=dtype, shape=new_shape)
+
+    for start in range(0, len(old_matrix), block_size):
+        new_matrix[start:start + block_size] = \
+            old_matrix[start:start + block_size]
+
+    new_matrix[len(old_matrix):] = rows
+    new_matrix.flush()
+
+    del new_matrix
+    del old_matrix
+
+    os.replace(tmp_path, npy_path)
+
+
+class CodeStore(object):
+
+    def __init__(self, store_dir_path, code_types=CODE_TYPES):
+        self.store_dir_path = pathlib.Path(store_dir_path)
+
+        with open(self.store_dir_path / MANIFEST_NAME, 'r') as f:
+            self.manifest = json.load(f)
+
+        self.n_rows = self.manifest['n_rows']
+        self.vector_lengths = self.manifest['vector_lengths']
+        self.code_types = [c for c in code_types if c in self.vector_lengths]
+
+        self.matrices = {}
+        for code_type in self.code_types:
+            self.matrices[code_type] = np.load(
+                self.store_dir_path / (code_type + '.npy'), mmap_mode='r')
+
+            assert self.matrices[code_type].shape == \
+                (self.n_rows, self.vector_lengths[code_type])
+
+        self.fingerprint = self.manifest.get('fingerprint')
+
+        if self.fingerprint is None:
+            self.fingerprint = self.compute_fingerprint()
+            self.manifest['fingerprint'] = self.fingerprint
+            self.save_manifest()
+
+    @classmethod
+    def exists(cls, store_dir_path):
+        return os.path.exists(pathlib.Path(store_dir_path) / MANIFEST_NAME)
+
+    @classmethod
+    def has_shards(cls, store_dir_path):
+        return len(glob.glob(
+            str(pathlib.Path(store_dir_path) / 'manifest-*.json'))) > 0
+
+    @classmethod
+    def get_source_paths(cls, store_dir_path, code_dir_path=None,
+                         code_types=CODE_TYPES, verify_files=False):
+        # What a store is packed from: the shards when present, the
+        # per-slice files under code_dir_path otherwise. Stating every
+        # per-slice file costs as much as reading them, so by default only
+        # the patient directories are listed; their mtimes follow files
+        # being added, removed or renamed, but not files rewritten in place.
+        store_dir_path = pathlib.Path(store_dir_path)
+
+        if cls.has_shards(store_dir_path):
+            paths = glob.glob(str(store_dir_path / 'manifest-*.json'))
+            for code_type in code_types:
+                paths += glob.glob(str(store_dir_path / (code_type + '-*.npy')))
+            return sorted(paths)
+
+        if code_dir_path is None:
+            return []
+
+        if not verify_files:
+            return sorted(
+                path for path in glob.glob(
+                    str(pathlib.Path(code_dir_path) / '*'))
+                if os.path.isdir(path)
+                and os.path.basename(path) != CODE_STORE_DIR_NAME)
+
+        paths = []
+        for code_type in code_types:
+            paths += glob.glob(str(
+                pathlib.Path(code_dir_path) / '*' / (code_type + '_*.npy')))
+
+        return sorted(paths)
+
+    @classmethod
+    def compute_source_fingerprint(cls, store_dir_path, code_dir_path=None,
+                                   code_types=CODE_TYPES, verify_files=False):
+        # Name, size and mtime of every source path; regenerated codes
+        # change it without the row count changing. None without sources.
+        paths = cls.get_source_paths(store_dir_path, code_dir_path,
+                                     code_types, verify_files)
+
+        if len(paths) == 0:
+            return None
+
+        sha1 = hashlib.sha1()
+        for path in paths:
+            stat = os.stat(path)
+            sha1.update('{}:{}:{}\n'.format(
+                os.path.basename(os.path.dirname(path)) + '/'
+                + os.path.basename(path),
+                stat.st_size, stat.st_mtime_ns).encode())
+
+        return sha1.hexdigest()
+
+    @classmethod
+    def pack(cls,
+             store_dir_path,
+             db_indices,
+             patient_ids,
+             slice_nums,
+             code_dir_path=None,
+             code_types=CODE_TYPES,
+             verify_files=False):
+        # Rows are laid out by db_index, so row i always holds the codes of
+        # the record whose db_index is i. Codes are taken from the shards
+        # written by DecompTrainerBase.test_step when present and from the
+        # legacy per-slice .npy files under code_dir_path otherwise.
+        store_dir_path = pathlib.Path(store_dir_path)
+        os.makedirs(store_dir_path, exist_ok=True)
+
+        db_indices = np.asarray(db_indices, dtype=np.int64)
+        n_rows = int(db_indices.max()) + 1
+
+        row_patient_ids = [''] * n_rows
+        row_slice_nums = [-1] * n_rows
+        for db_index, patient_id, slice_num in zip(
+                db_indices, patient_ids, slice_nums):
+            row_patient_ids[db_index] = patient_id
+            row_slice_nums[db_index] = int(slice_num)
+
+        source_fingerprint = cls.compute_source_fingerprint(
+            store_dir_path, code_dir_path, code_types, verify_files)
+
+        if cls.has_shards(store_dir_path):
+            source = cls._shard_source(store_dir_path, code_types)
+        else:
+            assert code_dir_path is not None
+            source = cls._slice_source(code_dir_path, code_types)
+
+        vector_lengths = {}
+        matrices = {}
+
+        print('Packing code store in {}.'.format(store_dir_path))
+        for db_index in tqdm(db_indices):
+            codes = source(row_patient_ids[db_index], row_slice_nums[db_index])
+
+            for code_type in code_types:
+                if code_type not in matrices:
+                    vector_lengths[code_type] = int(codes[code_type].size)
+                    matrices[code_type] = np.lib.format.open_memmap(
+                        store_dir_path / (code_type + '.npy'),
+                        mode='w+',
+                        dtype=np.float32,
+                        shape=(n_rows, vector_lengths[code_type]),
+                    )
+
+                matrices[code_type][db_index] = codes[code_type].flatten()
+
+        for matrix in matrices.values():
+            matrix.flush()
+
+        del matrices
+
+        manifest = {
+            'dtype': 'float32',
+            'n_rows': n_rows,
+            'vector_lengths': vector_lengths,
+            'patient_ids': row_patient_ids,
+            'slice_nums': row_slice_nums,
+            'source_fingerprint': source_fingerprint,
+            'source_check': 'files' if verify_files else 'directories',
+        }
+
+        with open(store_dir_path / MANIFEST_NAME, 'w') as f:
+            json.dump(manifest, f)
+
+        return cls(store_dir_path, code_types=code_types)
+
+    @classmethod
+    def _shard_source(cls, store_dir_path, code_types):
+        shard_rows = {}
+        shard_matrices = {}
+
+        for manifest_path in sorted(glob.glob(
+                str(store_dir_path / 'manifest-*.json'))):
+            with open(manifest_path, 'r') as f:
+                shard_manifest = json.load(f)
+
+            shard_name = shard_manifest['shard_name']
+            shard_matrices[shard_name] = {
+                code_type: np.load(
+                    store_dir_path / (code_type + '-' + shard_name + '.npy'),
+                    mmap_mode='r')
+                for code_type in code_types
+            }
+
+            for row, (patient_id, slice_num) in enumerate(zip(
+                    shard_manifest['patient_ids'],
+                    shard_manifest['slice_nums'])):
+                shard_rows[slice_key(patient_id, slice_num)] = (shard_name, row)
+
+        def source(patient_id, slice_num):
+            shard_name, row = shard_rows[slice_key(patient_id, slice_num)]
+            return {
+                code_type: shard_matrices[shard_name][code_type][row]
+                for code_type in code_types
+            }
+
+        return source
+
+    @classmethod
+    def _slice_source(cls, code_dir_path, code_types):
+        code_dir_path = pathlib.Path(code_dir_path)
+
+        def source(patient_id, slice_num):
+            codes = {}
+            for code_type in code_types:
+                code_path = code_dir_path / patient_id / \
+                    (code_type + '_' + str(slice_num).zfill(4) + '.npy')
+                codes[code_type] = np.load(code_path).astype(np.float32)
+            return codes
+
+        return source
+
+    def compute_fingerprint(self):
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(
+            [self.manifest['patient_ids'], self.manifest['slice_nums']]
+        ).encode())
+
+        for code_type in sorted(self.code_types):
+            matrix = self.matrices[code_type]
+            for start in range(0, self.n_rows, FINGERPRINT_BLOCK_SIZE):
+                sha1.update(np.ascontiguousarray(
+                    matrix[start:start + FINGERPRINT_BLOCK_SIZE]).tobytes())
+
+        return sha1.hexdigest()
+
+    def append(self, db_indices, patient_ids, slice_nums, codes):
+        # codes maps every code type of the store to an (n, vector_length)
+        # matrix. New rows must continue the dense db_index range, and the
+        # fingerprint is chained instead of recomputed over the whole store.
+        assert set(self.code_types) == set(self.vector_lengths)
+
+        db_indices = np.asarray(db_indices, dtype=np.int64)
+        assert np.array_equal(
+            db_indices,
+            np.arange(self.n_rows, self.n_rows + len(db_indices)))
+
+        patient_ids = list(patient_ids)
+        slice_nums = [int(slice_num) for slice_num in slice_nums]
+
+        sha1 = hashlib.sha1(self.fingerprint.encode())
+        sha1.update(json.dumps([patient_ids, slice_nums]).encode())
+
+        for code_type in sorted(self.code_types):
+            rows = np.asarray(codes[code_type], dtype=np.float32)
+            rows = rows.reshape(len(db_indices), -1)
+            assert rows.shape[1] == self.vector_lengths[code_type]
+
+            append_npy_rows(self.store_dir_path / (code_type + '.npy'), rows)
+            sha1.update(rows.tobytes())
+
+        self.n_rows += len(db_indices)
+        self.fingerprint = sha1.hexdigest()
+
+        self.manifest['n_rows'] = self.n_rows
+        self.manifest['patient_ids'] += patient_ids
+        self.manifest['slice_nums'] += slice_nums
+        self.manifest['fingerprint'] = self.fingerprint
+        self.save_manifest()
+
+        for code_type in self.code_types:
+            self.matrices[code_type] = np.load(
+                self.store_dir_path / (code_type + '.npy'), mmap_mode='r')
+
+    def is_up_to_date(self, code_dir_path=None, verify_files=False):
+        # False when the shards or per-slice files changed since packing. A
+        # fingerprint recorded with the other kind of check is not
+        # comparable and counts as out of date.
+        if self.manifest.get('source_check') != \
+                ('files' if verify_files else 'directories'):
+            return False
+
+        source_fingerprint = self.compute_source_fingerprint(
+            self.store_dir_path, code_dir_path, self.code_types, verify_files)
+
+        return source_fingerprint is None or \
+            source_fingerprint == self.manifest.get('source_fingerprint')
+
+    def set_source_fingerprint(self, code_dir_path=None):
+        self.manifest['source_fingerprint'] = self.compute_source_fingerprint(
+            self.store_dir_path, code_dir_path, self.code_types,
+            self.manifest.get('source_check') == 'files')
+        self.save_manifest()
+
+    def save_manifest(self):
+        with open(self.store_dir_path / MANIFEST_NAME, 'w') as f:
+            json.dump(self.manifest, f)
+
+    def __len__(self):
+        return self.n_rows
+
+    def get(self, code_type, db_index):
+        return np.array(self.matrices[code_type][db_index], dtype=np.float32)
+
+    def get_rows(self, code_type, db_indices):
+        return np.asarray(
+            self.matrices[code_type][np.asarray(db_indices)], dtype=np.float32)
+
+    def get_matrix(self, code_type):
+        return self.matrices[code_type]
@@ -1,35 +1,63 @@
 import os
+import json
+import time
+import hashlib
 import pathlib
+import threading
 import numpy as np
 from tqdm import tqdm
 import mongoengine as db
-from annoy import AnnoyIndex
-from operator import itemgetter
+from collections import namedtuple
 from mongoengine.queryset.visitor import Q
 from mongoengine.connection import disconnect
-from multiprocessing import Pool
 
+from .code_store import CodeStore
+from .slice_table import SliceTable
+from .patient_index import PatientIndex
+from .pq_index import PQIndex
+from .pq_index import PQ_N_SUBVECTORS
+from .pq_index import PQ_N_RERANK
+from .projection import PCAProjection
+from .dice_engine import DiceEngine
+from .retrieved_writer import RetrievedWriter
+from .neighbors import blocked_knn
+from .neighbors import KnnProgress
+from .neighbors import parallel_blocked_knn
+from .neighbors import NeighborGraph
+from .neighbors import KNN_BLOCK_SIZE
+from .index_backends import ExactIndex
+from .index_backends import AnnoyBackend
+from .index_backends import HNSWBackend
+from .index_backends import QUERY_BLOCK_SIZE
+from .index_backends import compare_indexes
+from .index_backends import merge_results
+from .code_store import CODE_STORE_DIR_NAME
 from .db_models import BraTSImage
 from .db_models import RetrievedByExample
 from .db_models import RetrievedByDice
 from .db_models import parse_dataset_type
 from .db_models import MICCAI_BraTS
 from .db_models import DB_TYPE_TO_VECTOR_LENGTH
+from .db_models import MODEL_NAMES
 
 
 RESNET_MODELS = {'imagenet_feature', 'finetuned_feature'}
 RESNET_MODELS_ALL = {'imagenet_feature_all', 'finetuned_feature_all'}
+RESNET_FEATURE_DIR_NAMES = {
+    'imagenet_feature': 'resnet-not-finetuned',
+    'finetuned_feature': 'resnet-finetuned',
+}
+INDEX_TYPES = {'annoy', 'exact', 'hnsw', 'pq'}
 TOPK = 30
+PATIENT_SEARCH_FACTOR = 2
+HUBNESS_SEARCH_FACTOR = 4
+N_HUBS = 20
 N_PROCESSES = 8
 ERROR_MESSAGE = 'Only the MICCAI BraTS 2019 dataset is available.'
 
 
-def unwrap_self_f(arg, **kwarg):
-    return DatabaseManager.f(*arg, **kwarg)
-
-
-def unwrap_self_g(arg, **kwarg):
-    return DatabaseManager.g(*arg, **kwarg)
+SliceHit = namedtuple(
+    'SliceHit', ['patient_id', 'slice_num', 'distance', 'db_index'])
 
 
 def db_connect(project_name, dataset_type, alias, host):
@@ -80,8 +108,23 @@ class DatabaseManager(object):
                  code_root_dir_path,
                  model_name=None,
                  n_trees=10,
+                 n_jobs=-1,
+                 on_disk_build=False,
+                 background_rebuild=True,
+                 index_type='annoy',
+                 patient_aggregation=None,
+                 pq_n_subvectors=PQ_N_SUBVECTORS,
+                 pq_use_opq=False,
+                 pq_n_rerank=PQ_N_RERANK,
+                 projection_dim=None,
+                 projection_whiten=False,
+                 hnsw_m=16,
+                 hnsw_ef_construction=200,
+                 hnsw_ef_search=100,
                  vector_length=None,
                  init_nearest_neighbors=False,
+                 use_code_store=True,
+                 verify_code_files=False,
                  alias='default',
                  host='localhost'):
         super().__init__()
@@ -92,6 +135,32 @@ class DatabaseManager(object):
         self.annoy_model_path = pathlib.Path(annoy_model_path)
 
         self.n_trees = n_trees
+        self.n_jobs = n_jobs
+        self.on_disk_build = on_disk_build
+        self.background_rebuild = background_rebuild
+        self.index_build_timings = None
+        self.index_build_thread = None
+        self.index_type = index_type
+        self.patient_aggregation = patient_aggregation
+        self.code_store = None
+        self.slice_table = None
+        self.index_model = None
+        self.delta_model = None
+        self.compaction_thread = None
+        self.exact_model = None
+        self.pq_n_subvectors = pq_n_subvectors
+        self.pq_use_opq = pq_use_opq
+        self.pq_n_rerank = pq_n_rerank
+        self.projection = None
+        self.projection_dim = projection_dim
+        self.projection_whiten = projection_whiten
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self.patient_index = None
+        self.verify_code_files = verify_code_files
+
+        assert self.index_type in INDEX_TYPES
 
         if vector_length is None:
             self.vector_length = DB_TYPE_TO_VECTOR_LENGTH[self.dataset_type]
@@ -105,6 +174,12 @@ class DatabaseManager(object):
                               nifti_root_dir_path,
                               code_root_dir_path)
 
+        self.init_slice_table()
+
+        if use_code_store and \
+                self.model_name in MODEL_NAMES[self.dataset_type]:
+            self.init_code_store()
+
         if self.model_name is not None:
             if self.model_name in RESNET_MODELS:
                 if init_nearest_neighbors:
@@ -119,7 +194,7 @@ class DatabaseManager(object):
                     self.init_nearest_neighbors_dice()
 
             else:
-                self.init_annoy_model()
+                self.init_search_index()
 
     def init_db(self, project_name, alias, host):
         db_connect(project_name, self.dataset_name, alias, host)
@@ -145,6 +220,58 @@ class DatabaseManager(object):
         if self.image_model.is_empty_database(self.dataset_name):
             self.image_model.build_dataset(self.dataset_name)
 
+    def get_code_dir_path(self):
+        return self.image_model.CODE_ROOT_DIR_PATH \
+            / self.dataset_name \
+            / self.model_name
+
+    def init_slice_table(self):
+        self.slice_table = SliceTable(
+            self.image_model.get_slice_table(self.dataset_name))
+
+    def get_slice_table(self):
+        return self.slice_table
+
+    def init_code_store(self):
+        store_dir_path = self.get_code_dir_path() / CODE_STORE_DIR_NAME
+        code_store = None
+
+        if CodeStore.exists(store_dir_path):
+            code_store = CodeStore(store_dir_path)
+
+            if len(code_store) != len(self.slice_table.patient_idx):
+                print('Code store in {} is out of date.'.format(
+                    store_dir_path))
+                code_store = None
+
+            # Regenerated codes keep the row count, so the sources are
+            # compared as well. A repacked store gets a new content
+            # fingerprint, which invalidates the search indexes.
+            elif not code_store.is_up_to_date(self.get_code_dir_path(),
+                                              self.verify_code_files):
+                print('Codes of the code store in {} have changed.'.format(
+                    store_dir_path))
+                code_store = None
+
+        if code_store is None:
+            db_indices = self.slice_table.db_indices
+
+            code_store = CodeStore.pack(
+                store_dir_path,
+                db_indices=db_indices,
+                patient_ids=self.slice_table.get_patient_ids(db_indices),
+                slice_nums=self.slice_table.slice_num[db_indices],
+                code_dir_path=self.get_code_dir_path(),
+                verify_files=self.verify_code_files,
+            )
+
+        self.code_store = code_store
+        self.image_model.init_code_store(
+            self.dataset_name, self.model_name, self.code_store)
+
+    def get_code_store(self):
+        return self.code_store
+
     def get_image_model(self):
         return self.image_model
 
@@ -179,6 +306,9 @@ class DatabaseManager(object):
         assert len(images) == 1
         return images[0]
 
+    def get_images_by_db_indices(self, db_indices):
+        return self.image_model.get_records_by_db_indices(db_indices)
+
     def get_representative_image(self, patient_id):
         images = self.image_model.objects((
             Q(dataset_name=self.dataset_name) & Q(
@@ -187,287 +317,984 @@ class DatabaseManager(object):
         assert len(images) == 1
         return images[0]
 
-    def init_annoy_model(self):
-        try:
-            assert self.model_name is not None
-        except Exception:
-            raise Exception('Model name was not specified.')
-
-        save_dir_path = self.annoy_model_path \
-            / self.dataset_type \
-            / self.dataset_name
-        annoy_model_name = self.model_name + '-n-' + str(self.n_trees) + '.ann'
-        annoy_model_path = save_dir_path / annoy_model_name
+    def init_search_index(self):
+        if self.projection_dim is not None:
+            self.init_projection()
 
-        if not os.path.exists(annoy_model_path):
-            annoy_model = self.build_annoy_model()
-            os.makedirs(save_dir_path, exist_ok=True)
-            annoy_model.save(str(annoy_model_path))
+        if self.index_type == 'exact':
+            self.init_exact_model()
+            self.index_model = self.exact_model
 
         else:
-            annoy_model = AnnoyIndex(self.vector_length, self.distance_metric)
-            annoy_model.load(str(annoy_model_path))
-
-        self.annoy_model = annoy_model
+            self.init_index_model()
+
+        if self.patient_aggregation is not None:
+            self.init_patient_index()
+
+    def use_exact_model(self):
+        # The exact model also serves queries while a stale or missing
+        # index is rebuilt in the background.
+        return self.index_type == 'exact' or self.index_model is None
+
+    def create_index_model(self):
+        vector_length = self.get_index_vector_length()
+
+        if self.index_type == 'annoy':
+            return AnnoyBackend(vector_length, self.distance_metric,
+                                n_trees=self.n_trees,
+                                n_jobs=self.n_jobs,
+                                on_disk_build=self.on_disk_build,
+                                n_threads=N_PROCESSES)
+
+        elif self.index_type == 'hnsw':
+            return HNSWBackend(vector_length, self.distance_metric,
+                               m=self.hnsw_m,
+                               ef_construction=self.hnsw_ef_construction,
+                               ef_search=self.hnsw_ef_search,
+                               n_threads=self.n_jobs)
+
+        elif self.index_type == 'pq':
+            return PQIndex(vector_length, self.distance_metric,
+                           n_subvectors=self.pq_n_subvectors,
+                           use_opq=self.pq_use_opq,
+                           n_rerank=self.pq_n_rerank)
+
+        return ExactIndex(vector_length, self.distance_metric)
+
+    def get_index_model_path(self, index_model):
+        return self.annoy_model_path \
+            / self.dataset_type \
+            / self.dataset_name \
+            / index_model.get_file_name(self.model_name)
 
-    def get_annoy_model(self):
-        return self.annoy_model
+    def get_index_manifest(self, index_model):
+        manifest = self.get_reference_manifest()
+        manifest.update(index_model.get_params())
+        return manifest
 
-    def build_annoy_model(self):
-        annoy_model = AnnoyIndex(self.vector_length, self.distance_metric)
+    def init_index_model(self):
+        try:
+            assert self.model_name is not None
+        except Exception:
+            raise Exception('Model name was not specified.')
 
-        print('Building annoy model for {} in {}.'.format(
-            self.model_name, self.dataset_name))
-        for image_record in tqdm(self.image_model.get_all_records_in_dataset(
-                self.dataset_name)):
-            db_index = image_record.db_index
+        index_model = self.create_index_model()
+        index_model_path = self.get_index_model_path(index_model)
+        manifest_path = index_model_path.with_name(
+            index_model_path.name + '.json')
 
-            if self.model_name == 'imagenet_feature_annoy':
-                feature = image_record.imagenet_feature
+        manifest = self.get_index_manifest(index_model)
 
-            elif self.model_name == 'finetuned_feature_annoy':
-                feature = image_record.finetuned_feature
+        if os.path.exists(index_model_path) and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                saved_manifest = json.load(f)
 
-            else:
-                feature = image_record.eac
+            if saved_manifest == manifest:
+                index_model.load(index_model_path)
 
-            annoy_model.add_item(db_index, feature)
+                if index_model.uses_rerank_matrix:
+                    index_model.set_rerank_matrix(
+                        self.load_reference_matrix()[1])
 
-        annoy_model.build(self.n_trees)
+                self.index_model = index_model
+                return
 
-        return annoy_model
+        print('{} index {} is missing or out of date.'.format(
+            self.index_type, index_model_path))
+        self.index_model = None
 
-    def query(self, query, topk):
-        results = []
+        if self.background_rebuild:
+            if self.exact_model is None:
+                self.init_exact_model()
 
-        for db_index in self.annoy_model.get_nns_by_vector(query, topk):
-            results.append(
-                self.image_model.get_record_by_db_index(db_index)
+            self.index_build_thread = threading.Thread(
+                target=self.rebuild_index_model,
+                args=(index_model, index_model_path, manifest_path, manifest),
+                daemon=True,
             )
+            self.index_build_thread.start()
 
-        return results
-
-    def get_nearest_slices_with_patient_filter(self,
-                                               query_record,
-                                               topk_patient,
-                                               topk_record=100):
-        patient_ids = []
-        filtered_results = []
-
-        query = query_record.eac
-        raw_results = self.query(query, topk=topk_record)
+        else:
+            self.rebuild_index_model(
+                index_model, index_model_path, manifest_path, manifest)
+
+    def rebuild_index_model(self,
+                            index_model,
+                            index_model_path,
+                            manifest_path,
+                            manifest):
+        os.makedirs(index_model_path.parent, exist_ok=True)
+        tmp_path = index_model_path.with_name(index_model_path.name + '.tmp')
+        timings = {}
+
+        print('Building {} index for {} in {}.'.format(
+            self.index_type, self.model_name, self.dataset_name))
+
+        start = time.perf_counter()
+        db_indices, matrix = self.load_reference_matrix()
+        timings['load'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index_model.build(db_indices, matrix, path=tmp_path)
+        timings['build'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index_model.save(tmp_path)
+        timings['save'] = time.perf_counter() - start
+
+        print('Built {} index with {} items: '.format(
+            self.index_type, len(db_indices)) +
+            ', '.join('{} {:.1f}s'.format(k, v) for k, v in timings.items()))
+
+        # The index is written under a temporary name first, so readers
+        # never see a half-written file.
+        index_model.unload()
+        os.replace(tmp_path, index_model_path)
+
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        index_model.load(index_model_path)
+
+        if index_model.uses_rerank_matrix:
+            index_model.set_rerank_matrix(matrix)
+
+        self.index_build_timings = timings
+        self.index_model = index_model
+
+    def wait_for_index_model(self):
+        if self.index_build_thread is not None:
+            self.index_build_thread.join()
+            self.index_build_thread = None
+
+    def get_index_model(self):
+        return self.index_model
+
+    def compare_index_with_exact(self,
+                                 n_queries=100,
+                                 topk=10,
+                                 query_params=({},),
+                                 seed=0):
+        # query_params holds the query-time settings to evaluate, e.g.
+        # search_k for annoy, ef_search for hnsw or n_rerank for pq.
+        if self.exact_model is None:
+            self.init_exact_model()
+
+        if self.index_model is None and self.index_build_thread is None:
+            self.init_search_index()
+
+        self.wait_for_index_model()
+
+        matrix = self.exact_model.matrix
+        rng = np.random.RandomState(seed)
+        rows = rng.choice(len(matrix), size=min(n_queries, len(matrix)),
+                          replace=False)
+        queries = matrix[rows]
+
+        query_fns = {}
+        for params in query_params:
+            name = '-'.join([self.index_type] + [
+                '{}-{}'.format(k, v) for k, v in sorted(params.items())])
+            query_fns[name] = (
+                lambda q, k, params=params:
+                    self.index_model.query(q, k, **params)[0].tolist()
+            )
 
-        for result in raw_results:
-            if result.is_same_patient(query_record):
-                continue
+        return compare_indexes(self.exact_model, query_fns, queries, topk)
 
-            if result.patient_id not in patient_ids:
-                patient_ids.append(result.patient_id)
-                filtered_results.append(result)
+    def get_reference_vector(self, image_record):
+        if self.model_name == 'imagenet_feature_annoy':
+            return image_record.imagenet_feature
 
-        filtered_results = filtered_results[:topk_patient]
+        elif self.model_name == 'finetuned_feature_annoy':
+            return image_record.finetuned_feature
 
-        return filtered_results
+        return self.get_code(image_record, 'eac')
 
-    def get_nearest_slices_with_patient_filter_by_nac(self,
-                                                      query_record,
-                                                      topk_patient,
-                                                      topk_record=100):
-        patient_ids = []
-        filtered_results = []
+    def get_code(self, image_record, code_type):
+        # Read from the store of this manager, not from whichever model
+        # was last set on the image model.
+        if self.code_store is not None:
+            return self.code_store.get(code_type, image_record.db_index)
 
-        query = query_record.nac
-        raw_results = self.query(query, topk=topk_record)
+        return image_record.get_code(code_type, self.model_name)
 
-        for result in raw_results:
-            if result.is_same_patient(query_record):
-                continue
+    def get_index_vector_length(self):
+        if self.projection is not None:
+            return self.projection.n_components
 
-            if result.patient_id not in patient_ids:
-                patient_ids.append(result.patient_id)
-                filtered_results.append(result)
+        return self.vector_length
 
-        filtered_results = filtered_results[:topk_patient]
+    def project_query(self, query):
+        if self.projection is None:
+            return query
 
-        return filtered_results
+        return self.projection.transform(query)
 
-    def get_the_nearest_slice(self, query_record):
-        query = query_record.eac
-        raw_results = self.query(query, topk=2)
-
-        top1_result = raw_results[0]
-        top2_result = raw_results[1]
-
-        if not query_record.is_same_slice(top1_result):
-            nearest = top1_result
-        else:
-            nearest = top2_result
+    def init_projection(self):
+        # PCA (optionally whitened) learned on the reference eac codes.
+        # Every index of this model is then built in the projected space,
+        # and queries have to go through project_query first.
+        save_dir_path = self.annoy_model_path \
+            / self.dataset_type \
+            / self.dataset_name
+        projection_name = self.model_name + '-pca-' + str(self.projection_dim) \
+            + ('-whiten' if self.projection_whiten else '') + '.npz'
+        projection_path = save_dir_path / projection_name
+        manifest_path = save_dir_path / (projection_name + '.json')
+
+        manifest = self.get_reference_manifest()
+        manifest['projection_dim'] = self.projection_dim
+        manifest['projection_whiten'] = self.projection_whiten
+
+        if os.path.exists(projection_path) and os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                saved_manifest = json.load(f)
+
+            if saved_manifest == manifest:
+                self.projection = PCAProjection.load(projection_path)
+                return
+
+        _, matrix = self.load_raw_reference_matrix()
+        projection = PCAProjection(
+            self.projection_dim, whiten=self.projection_whiten).fit(matrix)
+
+        os.makedirs(save_dir_path, exist_ok=True)
+        tmp_path = projection_path.with_name(projection_path.name + '.tmp')
+        projection.save(tmp_path)
+        os.replace(tmp_path, projection_path)
+
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        self.projection = projection
+
+    def evaluate_projection(self, n_queries=100, topk=10, seed=0):
+        # Neighbour overlap between exact search in the original space and
+        # exact search in the projected space.
+        if self.projection is None:
+            self.init_projection()
+
+        db_indices, raw_matrix = self.load_raw_reference_matrix()
+        raw_model = ExactIndex(self.vector_length, self.distance_metric)
+        raw_model.add_items(db_indices, raw_matrix)
+
+        projected_model = ExactIndex(
+            self.projection.n_components, self.distance_metric)
+        projected_model.add_items(
+            db_indices, self.projection.transform_matrix(raw_matrix))
+
+        rng = np.random.RandomState(seed)
+        rows = rng.choice(len(db_indices), size=min(n_queries, len(db_indices)),
+                          replace=False)
+        queries = np.asarray(raw_matrix[np.sort(rows)], dtype=np.float32)
+
+        raw_ids, _ = raw_model.query_batch(queries, topk + 1)
+        projected_ids, _ = projected_model.query_batch(
+            self.projection.transform(queries), topk + 1)
+
+        overlaps = []
+        for q_db_index, r_ids, p_ids in zip(
+                db_indices[np.sort(rows)], raw_ids, projected_ids):
+            r_ids = set(r_ids.tolist()) - {int(q_db_index)}
+            p_ids = set(p_ids.tolist()) - {int(q_db_index)}
+            overlaps.append(len(r_ids & p_ids) / max(len(r_ids), 1))
+
+        return {
+            'n_components': self.projection.n_components,
+            'whiten': self.projection.whiten,
+            'explained_variance_ratio': self.projection.explained_variance_ratio,
+            'neighbour_overlap': float(np.mean(overlaps)),
+        }
+
+    def load_reference_matrix(self):
+        db_indices, matrix = self.load_raw_reference_matrix()
+
+        if self.projection is not None:
+            matrix = self.projection.transform_matrix(matrix)
+
+        return db_indices, matrix
+
+    def load_raw_reference_matrix(self):
+        if self.code_store is not None and \
+                self.model_name in MODEL_NAMES[self.dataset_type]:
+            return np.arange(len(self.code_store)), \
+                self.code_store.get_matrix('eac')
+
+        db_indices = []
+        vectors = []
+        for image_record in tqdm(self.image_model.get_all_records_in_dataset(
+                self.dataset_name)):
+            db_indices.append(image_record.db_index)
+            vectors.append(self.get_reference_vector(image_record))
 
-        return nearest
+        return np.asarray(db_indices), np.stack(vectors, axis=0)
 
-    def f(self, q_record):
-        print(q_record.patient_id)
+    def init_exact_model(self):
+        try:
+            assert self.model_name is not None
+        except Exception:
+            raise Exception('Model name was not specified.')
 
-        all_records = self.get_all_images()
-        q_patient_id = q_record.patient_id
-        q_vector = getattr(q_record, self.model_name[:-4])
+        print('Loading exact index for {} in {}.'.format(
+            self.model_name, self.dataset_name))
+        db_indices, matrix = self.load_reference_matrix()
 
-        results = []
-        for r_record in tqdm(all_records):
-            r_patient_id = r_record.patient_id
+        exact_model = ExactIndex(
+            self.get_index_vector_length(), self.distance_metric)
+        exact_model.add_items(db_indices, matrix)
 
-            if q_patient_id == r_patient_id:
-                continue
+        self.exact_model = exact_model
 
-            r_vector = getattr(r_record, self.model_name[:-4])
+    def get_exact_model(self):
+        return self.exact_model
 
-            distance = np.linalg.norm(q_vector - r_vector)
+    def init_patient_index(self):
+        print('Building {} patient index for {} in {}.'.format(
+            self.patient_aggregation, self.model_name, self.dataset_name))
 
-            results.append({
-                'record': r_record,
-                'distance': distance,
-            })
+        if self.exact_model is not None and \
+                self.exact_model.get_n_items() == len(self.slice_table):
+            db_indices, matrix = self.exact_model.ids, self.exact_model.matrix
+        else:
+            db_indices, matrix = self.load_reference_matrix()
 
-        results = sorted(results, key=itemgetter('distance'))
-        topk_nearest_records = results[:TOPK]
+        self.patient_index = PatientIndex(
+            self.slice_table, db_indices, matrix,
+            aggregation=self.patient_aggregation)
 
-        for nearest in topk_nearest_records:
-            nearest_record = nearest['record']
+    def get_patient_index(self):
+        return self.patient_index
 
-            retrieved = RetrievedByExample.create_record(
-                patient_id=nearest_record.patient_id,
-                dataset_name=self.dataset_name,
-                slice_num=nearest_record.slice_num,
-                model_name=self.model_name,
-                distance_value=nearest['distance'],
-            )
+    def get_reference_fingerprint(self):
+        # init_code_store repacks the store when its source files changed,
+        # so the content fingerprint follows regenerated codes.
+        if self.code_store is not None and \
+                self.model_name in MODEL_NAMES[self.dataset_type]:
+            return self.code_store.fingerprint
+
+        return hashlib.sha1(
+            self.slice_table.db_indices.tobytes()).hexdigest()
+
+    def get_reference_manifest(self):
+        manifest = {
+            'dataset_name': self.dataset_name,
+            'model_name': self.model_name,
+            'fingerprint': self.get_reference_fingerprint(),
+            'n_items': len(self.slice_table),
+            'vector_length': self.vector_length,
+            'metric': self.distance_metric,
+        }
+
+        if self.projection is not None:
+            manifest['projection'] = {
+                'n_components': self.projection.n_components,
+                'whiten': self.projection.whiten,
+            }
+
+        return manifest
+
+    def get_search_model(self):
+        return self.exact_model if self.use_exact_model() else self.index_model
+
+    def query_index(self, query, topk, projected=False):
+        # Queries are raw codes and go through the projection of the
+        # index, unless projected is set (e.g. for rows of the index).
+        if not projected:
+            query = self.project_query(query)
+
+        db_indices, distances = self.get_search_model().query(query, topk)
+
+        delta_model = self.delta_model
+        if delta_model is not None:
+            db_indices, distances = merge_results(
+                db_indices, distances, *delta_model.query(query, topk),
+                topk=topk)
+
+        return np.asarray(db_indices, dtype=np.int64), \
+            np.asarray(distances, dtype=np.float32)
+
+    def query_batch(self, queries, topk, projected=False):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+
+        if not projected:
+            queries = self.project_query(queries)
+
+        db_indices, distances = self.get_search_model().query_batch(
+            queries, topk)
+
+        delta_model = self.delta_model
+        if delta_model is None:
+            return db_indices, distances
+
+        topk = min(topk, self.get_n_items())
+        delta_db_indices, delta_distances = delta_model.query_batch(
+            queries, topk)
+
+        merged_db_indices = np.full((len(queries), topk), -1, dtype=np.int64)
+        merged_distances = np.full((len(queries), topk), np.inf,
+                                   dtype=np.float32)
+
+        for i in range(len(queries)):
+            ids, dists = merge_results(
+                db_indices[i], distances[i],
+                delta_db_indices[i], delta_distances[i], topk=topk)
+            merged_db_indices[i, :len(ids)] = ids
+            merged_distances[i, :len(dists)] = dists
+
+        return merged_db_indices, merged_distances
+
+    def query(self, query, topk, hydrate=True, projected=False):
+        db_indices, distances = self.query_index(query, topk, projected)
+
+        if hydrate:
+            return self.image_model.get_records_by_db_indices(db_indices)
+
+        return self.to_slice_hits(db_indices, distances)
+
+    def get_n_items(self):
+        n_items = self.get_search_model().get_n_items()
+
+        if self.delta_model is not None:
+            n_items += self.delta_model.get_n_items()
+
+        return n_items
+
+    def ingest_patient(self, patient_id, codes=None):
+        # Makes a new patient searchable without rebuilding the main index:
+        # its slice records get fresh db_index values, its codes are
+        # appended to the code store and its vectors go into a small exact
+        # delta index that is searched alongside the main one until the
+        # next compaction. codes optionally maps eac/nac/aac to
+        # (n_slices, vector_length) matrices; by default they are read from
+        # the shards or, without shards, the per-slice files written by the
+        # trainer.
+        try:
+            assert self.code_store is not None
+        except Exception:
+            raise Exception('Ingestion requires the code store.')
 
-            q_record.add_retrieved(retrieved, self.model_name)
+        assert patient_id not in self.slice_table.patient_ids
 
-    def init_nearest_neighbors_all(self):
-        pool = Pool(processes=N_PROCESSES)
-        all_records = self.get_all_images()
-        pool.map(unwrap_self_f, zip([self] * len(all_records), all_records))
+        records = self.image_model.add_patient(
+            self.dataset_name, patient_id, self.image_model.get_next_db_index())
 
-    def init_nearest_neighbors_dice(self, topk=TOPK):
-        all_rep_records = self.get_all_representative_images()
-        all_records = self.get_all_images()
+        db_indices = [record.db_index for record in records]
+        slice_nums = [record.slice_num for record in records]
 
-        if self.dataset_type == MICCAI_BraTS:
-            n_classes_normal = 7
-            n_classes_abnormal = 4
+        if codes is None:
+            if CodeStore.has_shards(self.code_store.store_dir_path):
+                source = CodeStore._shard_source(
+                    self.code_store.store_dir_path, self.code_store.code_types)
+            else:
+                source = CodeStore._slice_source(
+                    self.get_code_dir_path(), self.code_store.code_types)
+            slice_codes = [source(patient_id, s) for s in slice_nums]
+            codes = {
+                code_type: np.stack([
+                    c[code_type].flatten() for c in slice_codes])
+                for code_type in self.code_store.code_types
+            }
+
+        self.code_store.append(
+            db_indices, [patient_id] * len(records), slice_nums, codes)
+        # The new shard or per-slice files are part of the store now, so
+        # they must not trigger a repack on the next start.
+        self.code_store.set_source_fingerprint(self.get_code_dir_path())
+        self.init_slice_table()
+
+        if self.exact_model is not None or self.index_model is not None:
+            self.add_to_delta_model(
+                db_indices, self.project_query(codes['eac']))
+
+        if self.patient_index is not None:
+            self.init_patient_index()
+
+        return records
+
+    def add_to_delta_model(self, db_indices, matrix):
+        db_indices = np.asarray(db_indices, dtype=np.int64)
+        matrix = np.asarray(matrix, dtype=np.float32)
+
+        if self.delta_model is not None:
+            db_indices = np.concatenate([self.delta_model.ids, db_indices])
+            matrix = np.concatenate([self.delta_model.matrix, matrix])
+
+        # The delta model is replaced, never modified, so concurrent
+        # queries always see a consistent index.
+        delta_model = ExactIndex(
+            self.get_index_vector_length(), self.distance_metric)
+        delta_model.add_items(db_indices, matrix)
+        self.delta_model = delta_model
+
+    def get_delta_model(self):
+        return self.delta_model
+
+    def compact_index(self, background=True):
+        # Rebuilds the main index over the whole code store and then drops
+        # the delta rows it now contains.
+        self.wait_for_compaction()
+
+        if background:
+            self.compaction_thread = threading.Thread(
+                target=self._compact_index, daemon=True)
+            self.compaction_thread.start()
 
         else:
-            raise NotImplementedError(ERROR_MESSAGE)
+            self._compact_index()
 
-        for q_record in tqdm(all_rep_records):
-            q_patient_id = q_record.patient_id
-            q_normal = q_record.anatomy
-            q_abnormal = q_record.label
+    def _compact_index(self):
+        n_rows = len(self.code_store)
 
-            results = []
-            for r_record in tqdm(all_records):
-                r_patient_id = r_record.patient_id
+        if self.index_type == 'exact':
+            self.init_exact_model()
+            self.index_model = self.exact_model
 
-                if q_patient_id == r_patient_id:
-                    continue
-
-                r_normal = r_record.anatomy
-                r_abnormal = r_record.label
-
-                dice_normal = calc_dice(
-                    r_normal, q_normal, n_classes=n_classes_normal)
-                dice_abnormal = calc_dice(
-                    r_abnormal, q_abnormal, n_classes=n_classes_abnormal)
-                dice_mean = (dice_normal + dice_abnormal) / 2.0
-
-                results.append({
-                    'record': r_record,
-                    'dice_normal': dice_normal,
-                    'dice_abnormal': dice_abnormal,
-                    'dice_mean': dice_mean,
-                })
-
-            results = sorted(results, key=itemgetter(
-                'dice_mean'), reverse=True)
-            topk_nearest_records = results[:topk]
+        else:
+            index_model = self.create_index_model()
+            index_model_path = self.get_index_model_path(index_model)
+            manifest_path = index_model_path.with_name(
+                index_model_path.name + '.json')
 
-            for nearest in topk_nearest_records:
-                nearest_record = nearest['record']
+            self.rebuild_index_model(
+                index_model, index_model_path, manifest_path,
+                self.get_index_manifest(index_model))
 
-                retrieved = RetrievedByDice.create_record(
-                    patient_id=nearest_record.patient_id,
-                    dataset_name=self.dataset_name,
-                    slice_num=nearest_record.slice_num,
-                    model_name=self.model_name,
-                    abnormal_dice=nearest['dice_abnormal'],
-                    normal_dice=nearest['dice_normal'],
-                    mean_dice=nearest['dice_mean'],
-                )
+            if self.exact_model is not None:
+                self.init_exact_model()
 
-                q_record.add_retrieved(retrieved, self.model_name)
+        delta_model = self.delta_model
+        if delta_model is not None:
+            keep = delta_model.ids >= n_rows
 
-    def init_nearest_neighbors(self, topk=TOPK):
-        all_rep_records = self.get_all_representative_images()
+            if np.any(keep):
+                compacted = ExactIndex(
+                    self.get_index_vector_length(), self.distance_metric)
+                compacted.add_items(
+                    delta_model.ids[keep], delta_model.matrix[keep])
+                self.delta_model = compacted
 
-        for q_record in tqdm(all_rep_records):
-            q_patient_id = q_record.patient_id
-            q_vector = getattr(q_record, self.model_name)
+            else:
+                self.delta_model = None
+
+    def wait_for_compaction(self):
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+            self.compaction_thread = None
+
+    def query_distinct_patients(self,
+                                query,
+                                topk_patient,
+                                exclude_patient_id=None,
+                                exclude_db_index=None,
+                                projected=False):
+        if not projected:
+            query = self.project_query(query)
+
+        exclude_patient_idx = None
+        if exclude_patient_id is not None:
+            exclude_patient_idx = self.slice_table.get_patient_idx(
+                exclude_patient_id)
+
+        if self.patient_index is not None:
+            return self.patient_index.query(
+                query, topk_patient,
+                exclude_patient_idx=exclude_patient_idx,
+                exclude_db_index=exclude_db_index)
+
+        if self.use_exact_model():
+            db_indices, distances = self.exact_model.query_all(query)
+
+            delta_model = self.delta_model
+            if delta_model is not None:
+                delta_db_indices, delta_distances = delta_model.query_all(query)
+                db_indices = np.concatenate([db_indices, delta_db_indices])
+                distances = np.concatenate([distances, delta_distances])
+
+            positions = self.slice_table.min_per_patient(
+                db_indices, distances, topk=topk_patient,
+                exclude_patient_idx=exclude_patient_idx,
+                exclude_db_index=exclude_db_index)
+
+            return db_indices[positions], distances[positions]
+
+        # The approximate index is searched progressively: the number of
+        # retrieved slices is doubled until enough distinct patients are
+        # found or the whole index has been visited.
+        n_items = self.get_n_items()
+        topk_record = min(PATIENT_SEARCH_FACTOR * topk_patient, n_items)
+
+        while True:
+            db_indices, distances = self.query_index(
+                query, topk_record, projected=True)
+            positions = self.slice_table.first_per_patient(
+                db_indices, topk=topk_patient,
+                exclude_patient_idx=exclude_patient_idx,
+                exclude_db_index=exclude_db_index)
+
+            if len(positions) >= topk_patient or topk_record >= n_items:
+                break
+
+            topk_record = min(PATIENT_SEARCH_FACTOR * topk_record, n_items)
+
+        return db_indices[positions], distances[positions]
+
+    def to_slice_hits(self, db_indices, distances):
+        patient_ids = self.slice_table.get_patient_ids(db_indices)
+        slice_nums = self.slice_table.slice_num[db_indices]
+
+        return [
+            SliceHit(patient_id, int(slice_num), float(distance),
+                     int(db_index))
+            for patient_id, slice_num, distance, db_index in zip(
+                patient_ids, slice_nums, distances, db_indices)
+        ]
+
+    def filter_by_patient(self,
+                          db_indices,
+                          distances,
+                          topk_patient,
+                          exclude_patient_id=None,
+                          exclude_db_index=None):
+        exclude_patient_idx = None
+        if exclude_patient_id is not None:
+            exclude_patient_idx = self.slice_table.get_patient_idx(
+                exclude_patient_id)
+
+        positions = self.slice_table.first_per_patient(
+            db_indices,
+            topk=topk_patient,
+            exclude_patient_idx=exclude_patient_idx,
+            exclude_db_index=exclude_db_index,
+        )
+
+        return np.asarray(db_indices)[positions], \
+            np.asarray(distances)[positions]
+
+    def hydrate(self, slice_hits):
+        return self.get_images_by_db_indices(
+            [hit.db_index for hit in slice_hits])
+
+    def evaluate_patient_index(self,
+                               n_queries=100,
+                               topk_patient=10,
+                               n_candidates=None,
+                               seed=0):
+        # Recall of the distinct patients against the exact search, and the
+        # cost of the two stages as a fraction of all slices: the coarse
+        # stage scans one vector per patient, the rerank every slice of the
+        # candidate patients.
+        if self.exact_model is None:
+            self.init_exact_model()
+
+        if self.patient_index is None:
+            self.init_patient_index()
+
+        rng = np.random.RandomState(seed)
+        rows = rng.choice(self.exact_model.get_n_items(),
+                          size=min(n_queries, self.exact_model.get_n_items()),
+                          replace=False)
+
+        recalls = []
+        n_reranked = []
+        for row in rows:
+            query = self.exact_model.matrix[row]
+            exclude_db_index = int(self.exact_model.ids[row])
+
+            db_indices, distances = self.exact_model.query_all(query)
+            positions = self.slice_table.min_per_patient(
+                db_indices, distances, topk=topk_patient,
+                exclude_db_index=exclude_db_index)
+            exact_patients = set(
+                self.slice_table.patient_idx[db_indices[positions]].tolist())
+
+            coarse_db_indices, _ = self.patient_index.query(
+                query, topk_patient, n_candidates=n_candidates,
+                exclude_db_index=exclude_db_index)
+            coarse_patients = set(
+                self.slice_table.patient_idx[coarse_db_indices].tolist())
+
+            recalls.append(
+                len(exact_patients & coarse_patients) / len(exact_patients))
+
+            candidates = self.patient_index.get_candidates(
+                query, topk_patient, n_candidates)
+            n_reranked.append(np.sum(
+                np.diff(self.patient_index.offsets)[candidates]))
+
+        n_rows = self.exact_model.get_n_items()
+        reranked_fraction = float(np.mean(n_reranked) / n_rows)
+        searched_fraction = reranked_fraction + \
+            self.patient_index.get_n_items() / n_rows
+
+        return {
+            'recall': float(np.mean(recalls)),
+            'n_candidates': int(len(candidates)),
+            'reranked_fraction': reranked_fraction,
+            'searched_fraction': searched_fraction,
+            'reduction': 1.0 / searched_fraction,
+        }
+
+    def _get_nearest_slices_with_patient_filter(self,
+                                                query,
+                                                query_record,
+                                                topk_patient,
+                                                topk_record):
+        db_indices, distances = self.query_index(query, topk=topk_record)
+        db_indices, _ = self.filter_by_patient(
+            db_indices, distances, topk_patient,
+            exclude_patient_id=query_record.patient_id)
+
+        return self.get_images_by_db_indices(db_indices)
 
-            results = []
-            for r_record in all_rep_records:
-                r_patient_id = r_record.patient_id
+    def get_nearest_slices_with_patient_filter(self,
+                                               query_record,
+                                               topk_patient,
+                                               topk_record=100):
+        return self._get_nearest_slices_with_patient_filter(
+            self.get_code(query_record, 'eac'), query_record, topk_patient,
+            topk_record)
 
-                if q_patient_id == r_patient_id:
-                    continue
+    def get_nearest_slices_with_patient_filter_by_nac(self,
+                                                      query_record,
+                                                      topk_patient,
+                                                      topk_record=100):
+        return self._get_nearest_slices_with_patient_filter(
+            self.get_code(query_record, 'nac'), query_record, topk_patient,
+            topk_record)
 
-                r_vector = getattr(r_record, self.model_name)
+    def get_the_nearest_slice(self, query_record):
+        db_indices, _ = self.query_index(
+            self.get_code(query_record, 'eac'), topk=2)
+        db_indices = db_indices[db_indices != query_record.db_index]
+
+        return self.image_model.get_record_by_db_index(int(db_indices[0]))
+
+    def get_feature_store(self, feature_name):
+        feature_dir_path = self.image_model.CODE_ROOT_DIR_PATH \
+            / self.dataset_name \
+            / RESNET_FEATURE_DIR_NAMES[feature_name]
+        store_dir_path = feature_dir_path / CODE_STORE_DIR_NAME
+
+        if CodeStore.exists(store_dir_path):
+            feature_store = CodeStore(store_dir_path, code_types=('feature',))
+
+            if len(feature_store) == len(self.slice_table.patient_idx) and \
+                    feature_store.is_up_to_date(feature_dir_path,
+                                                self.verify_code_files):
+                return feature_store
+
+        db_indices = self.slice_table.db_indices
+
+        return CodeStore.pack(
+            store_dir_path,
+            db_indices=db_indices,
+            patient_ids=self.slice_table.get_patient_ids(db_indices),
+            slice_nums=self.slice_table.slice_num[db_indices],
+            code_dir_path=feature_dir_path,
+            code_types=('feature',),
+            verify_files=self.verify_code_files,
+        )
+
+    def _init_nearest_neighbors(self,
+                                feature_name,
+                                db_indices,
+                                topk,
+                                n_processes=N_PROCESSES):
+        feature_store = self.get_feature_store(feature_name)
+
+        # The workers map the store file itself when every row is used.
+        if np.array_equal(db_indices, np.arange(len(feature_store))):
+            matrix = feature_store.get_matrix('feature')
+        else:
+            matrix = feature_store.get_rows('feature', db_indices)
+        groups = self.slice_table.patient_idx[db_indices]
+
+        progress = KnnProgress(
+            str(self.annoy_model_path / self.dataset_type / self.dataset_name
+                / (self.model_name + '-knn.progress.json')),
+            params={
+                'fingerprint': feature_store.fingerprint,
+                'n_rows': len(db_indices),
+                'topk': topk,
+                'block_size': KNN_BLOCK_SIZE,
+            },
+        )
+
+        writer = RetrievedWriter(
+            self.image_model, RetrievedByExample, self.model_name)
+
+        print('Computing {}-nearest neighbors for {} in {}.'.format(
+            topk, self.model_name, self.dataset_name))
+        for start, nearest, distances in tqdm(parallel_blocked_knn(
+                matrix, groups, topk, n_processes,
+                skip_blocks=progress.completed_blocks)):
+            q_db_indices = db_indices[start:start + len(nearest)]
+
+            # A block interrupted half-way is redone from scratch.
+            writer.clear(q_db_indices)
+
+            for q_db_index, n_rows, n_distances in zip(
+                    q_db_indices, nearest, distances):
+                # Same-patient rows, the query slice included.
+                n_rows = n_rows[~np.isinf(n_distances)]
+                n_distances = n_distances[~np.isinf(n_distances)]
+
+                n_db_indices = db_indices[n_rows]
+                n_patient_ids = self.slice_table.get_patient_ids(n_db_indices)
+
+                writer.add(q_db_index, [
+                    {
+                        'patient_id': patient_id,
+                        'dataset_name': self.dataset_name,
+                        'slice_num': int(self.slice_table.slice_num[n_db_index]),
+                        'model_name': self.model_name,
+                        'distance_value': float(distance),
+                    }
+                    for n_db_index, patient_id, distance in zip(
+                        n_db_indices, n_patient_ids, n_distances)
+                ])
+
+            writer.flush()
+            progress.mark(start)
+
+    def init_nearest_neighbors_all(self, topk=TOPK, n_processes=N_PROCESSES):
+        self._init_nearest_neighbors(
+            self.model_name[:-4], self.slice_table.db_indices, topk,
+            n_processes=n_processes)
+
+    def get_dice_engine(self, map_name, n_classes):
+        planes_dir_path = self.annoy_model_path \
+            / self.dataset_type \
+            / self.dataset_name \
+            / ('dice-' + map_name)
 
-                distance = np.linalg.norm(q_vector - r_vector)
+        if DiceEngine.exists(planes_dir_path):
+            dice_engine = DiceEngine(planes_dir_path)
 
-                results.append({
-                    'record': r_record,
-                    'distance': distance,
-                })
+            if len(dice_engine) == len(self.slice_table.patient_idx):
+                return dice_engine
 
-            results = sorted(results, key=itemgetter('distance'))
-            topk_nearest_records = results[:topk]
+        records = self.image_model.get_all_records_in_dataset(
+            self.dataset_name).order_by('db_index')
 
-            for nearest in topk_nearest_records:
-                nearest_record = nearest['record']
+        return DiceEngine.pack(
+            planes_dir_path,
+            rows=self.slice_table.db_indices,
+            class_maps=(getattr(record, map_name) for record in records),
+            n_classes=n_classes,
+        )
 
-                retrieved = RetrievedByExample.create_record(
-                    patient_id=nearest_record.patient_id,
-                    dataset_name=self.dataset_name,
-                    slice_num=nearest_record.slice_num,
-                    model_name=self.model_name,
-                    distance_value=nearest['distance'],
-                )
+    def init_nearest_neighbors_dice(self, topk=TOPK):
+        if self.dataset_type == MICCAI_BraTS:
+            n_classes_normal = 7
+            n_classes_abnormal = 4
 
-                q_record.add_retrieved(retrieved, self.model_name)
+        else:
+            raise NotImplementedError(ERROR_MESSAGE)
 
-    def calc_isolated_samples(self, topk):
-        all_rep_records = self.get_all_representative_images()
+        normal_engine = self.get_dice_engine('anatomy', n_classes_normal)
+        abnormal_engine = self.get_dice_engine('label', n_classes_abnormal)
+
+        db_indices = self.slice_table.db_indices
+        patient_idx = self.slice_table.patient_idx[db_indices]
+        rep_db_indices = db_indices[
+            self.slice_table.is_representative[db_indices]]
+
+        writer = RetrievedWriter(
+            self.image_model, RetrievedByDice, self.model_name)
+        writer.clear(rep_db_indices)
+
+        for q_db_index in tqdm(rep_db_indices):
+            dice_normal = normal_engine.query(q_db_index)[db_indices]
+            dice_abnormal = abnormal_engine.query(q_db_index)[db_indices]
+            dice_mean = (dice_normal + dice_abnormal) / 2.0
+
+            q_patient_idx = self.slice_table.patient_idx[q_db_index]
+            scores = np.where(patient_idx == q_patient_idx, -np.inf, dice_mean)
+
+            k = min(topk, int(np.sum(patient_idx != q_patient_idx)))
+            nearest = np.argpartition(-scores, k - 1)[:k]
+            nearest = nearest[np.argsort(-scores[nearest], kind='stable')]
+
+            n_db_indices = db_indices[nearest]
+            n_patient_ids = self.slice_table.get_patient_ids(n_db_indices)
+
+            writer.add(q_db_index, [
+                {
+                    'patient_id': patient_id,
+                    'dataset_name': self.dataset_name,
+                    'slice_num': int(self.slice_table.slice_num[n_db_index]),
+                    'model_name': self.model_name,
+                    'abnormal_dice': float(dice_abnormal[i]),
+                    'normal_dice': float(dice_normal[i]),
+                    'mean_dice': float(dice_mean[i]),
+                }
+                for i, n_db_index, patient_id in zip(
+                    nearest, n_db_indices, n_patient_ids)
+            ])
+
+        writer.flush()
+
+    def init_nearest_neighbors(self, topk=TOPK, n_processes=N_PROCESSES):
+        db_indices = self.slice_table.db_indices
+        db_indices = db_indices[self.slice_table.is_representative[db_indices]]
+
+        self._init_nearest_neighbors(self.model_name, db_indices, topk,
+                                     n_processes=n_processes)
+
+    def load_neighbor_graph(self):
+        # One pass over the stored neighbour lists: every retrieved
+        # document is resolved to the db_index of the slice it points to.
+        if self.model_name == 'dice':
+            retrieved_model = RetrievedByDice
+        else:
+            retrieved_model = RetrievedByExample
+
+        field_name = 'retrieved_by_' + self.model_name
+
+        retrieved_to_db_index = {}
+        for doc in retrieved_model._get_collection().find(
+                {'dataset_name': self.dataset_name,
+                 'model_name': self.model_name},
+                {'patient_id': 1, 'slice_num': 1}):
+            retrieved_to_db_index[doc['_id']] = self.slice_table.get_db_index(
+                doc['patient_id'], doc['slice_num'])
+
+        q_db_indices = []
+        neighbor_lists = []
+        for doc in self.image_model._get_collection().find(
+                {'dataset_name': self.dataset_name, field_name: {'$ne': []}},
+                {'db_index': 1, field_name: 1}):
+            if field_name not in doc:
+                continue
 
-        isolated_samples = []
-        for q_record in tqdm(all_rep_records):
-            count = 0
+            q_db_indices.append(doc['db_index'])
+            neighbor_lists.append([
+                retrieved_to_db_index.get(object_id, -1)
+                for object_id in doc[field_name]
+            ])
 
-            for r_record in all_rep_records:
-                if r_record.patient_id == q_record.patient_id:
-                    continue
+        order = np.argsort(q_db_indices, kind='stable')
 
-                nearest_records = getattr(
-                    r_record, 'retrieved_by_' + self.model_name)[:topk]
+        return NeighborGraph.from_lists(
+            np.asarray(q_db_indices, dtype=np.int64)[order],
+            [neighbor_lists[i] for i in order],
+            n_rows=len(self.slice_table.patient_idx),
+            groups=self.slice_table.patient_idx,
+        )
 
-                for n_record in nearest_records:
-                    if n_record.is_identical(q_record):
-                        count += 1
+    def calc_isolated_samples(self, topk, neighbor_graph=None):
+        if neighbor_graph is None:
+            neighbor_graph = self.load_neighbor_graph()
 
-            if count == 0:
-                isolated_samples.append(q_record)
+        db_indices = self.slice_table.db_indices
+        rep_db_indices = db_indices[
+            self.slice_table.is_representative[db_indices]]
 
-        return isolated_samples
+        return self.get_images_by_db_indices(
+            neighbor_graph.isolated(topk, candidates=rep_db_indices))
 
     def check_if_retrieved_all(self):
         all_records = self.get_all_images()
@@ -491,52 +1318,147 @@ class DatabaseManager(object):
         else:
             return False
 
-    def g(self, q_record):
-        all_records = self.get_all_images()
+    def calc_isolated_samples_all(self, topk, neighbor_graph=None):
+        if neighbor_graph is None:
+            neighbor_graph = self.load_neighbor_graph()
 
-        count = 0
-        for r_record in all_records:
-            if r_record.patient_id == q_record.patient_id:
-                continue
+        return self.get_images_by_db_indices(
+            neighbor_graph.isolated(topk, candidates=self.slice_table.db_indices))
 
-            nearest_records = getattr(
-                r_record, 'retrieved_by_' + self.model_name)[:TOPK]
+    def build_neighbor_graph(self, topk=TOPK, search_depth=None):
+        # Cross-patient k-NN graph of the search index itself, so that the
+        # diagnostics reflect n_trees and the code normalization in use.
+        if self.exact_model is None and self.index_model is None:
+            self.init_search_index()
 
-            for n_record in nearest_records:
-                if n_record.is_identical(q_record):
-                    count += 1
-                    break
+        self.wait_for_index_model()
 
-        return q_record if count == 0 else None
+        if self.exact_model is not None:
+            db_indices, matrix = self.exact_model.ids, self.exact_model.matrix
+        else:
+            db_indices, matrix = self.load_reference_matrix()
 
-    def _calc_isolated_samples_all(self, topk):
-        pool = Pool(processes=N_PROCESSES)
-        all_records = self.get_all_images()
-        map_responses = pool.map(unwrap_self_g, zip(
-            [self] * len(all_records), all_records))
-        filtered_results = list(filter(lambda a: a is not None, map_responses))
-        return filtered_results
+        db_indices = np.asarray(db_indices, dtype=np.int64)
+        groups = self.slice_table.patient_idx
 
-    def calc_isolated_samples_all(self, topk):
-        all_records = self.get_all_images()
+        if self.use_exact_model():
+            neighbors = np.full((len(db_indices), topk), -1, dtype=np.int64)
+            for start, nearest, distances in blocked_knn(
+                    matrix, groups[db_indices], topk):
+                nearest = db_indices[nearest]
+                nearest[np.isinf(distances)] = -1
+                neighbors[start:start + len(nearest), :nearest.shape[1]] = nearest
 
-        isolated_samples = []
-        for q_record in tqdm(all_records):
-            count = 0
+            return NeighborGraph(db_indices, neighbors,
+                                 n_rows=len(groups), groups=groups)
+
+        if search_depth is None:
+            search_depth = topk * HUBNESS_SEARCH_FACTOR
 
-            for r_record in all_records:
-                if r_record.patient_id == q_record.patient_id:
-                    continue
+        # Adjacent slices of a patient are near-duplicates and can fill the
+        # whole search depth, leaving nothing after the same-patient hits
+        # are dropped. Rows short of topk are searched again, deeper each
+        # time, like in query_distinct_patients.
+        n_items = self.get_n_items()
+        row_groups = groups[db_indices]
+        n_needed = np.minimum(
+            topk, len(db_indices) - np.bincount(row_groups)[row_groups])
 
-                nearest_records = getattr(
-                    r_record, 'retrieved_by_' + self.model_name)[:topk]
+        neighbors = np.full((len(db_indices), topk), -1, dtype=np.int64)
+        pending = np.arange(len(db_indices))
 
-                for n_record in nearest_records:
-                    if n_record.is_identical(q_record):
-                        count += 1
-                        break
+        while True:
+            search_depth = min(search_depth, n_items)
 
-            if count == 0:
-                isolated_samples.append(q_record)
+            for start in tqdm(range(0, len(pending), QUERY_BLOCK_SIZE)):
+                rows = pending[start:start + QUERY_BLOCK_SIZE]
+                block_neighbors, _ = self.query_batch(
+                    matrix[rows], search_depth, projected=True)
 
-        return isolated_samples
+                graph = NeighborGraph(db_indices[rows], block_neighbors,
+                                      n_rows=len(groups),
+                                      groups=groups).compact(topk)
+                neighbors[rows, :graph.k] = graph.neighbors
+
+            n_valid = np.sum(neighbors[pending] >= 0, axis=1)
+            pending = pending[n_valid < n_needed[pending]]
+
+            if len(pending) == 0 or search_depth >= n_items:
+                break
+
+            search_depth *= PATIENT_SEARCH_FACTOR
+            print('{} slices have fewer than {} neighbours of other '
+                  'patients, searching {} deep.'.format(
+                      len(pending), topk, min(search_depth, n_items)))
+
+        try:
+            assert len(pending) == 0
+        except Exception:
+            raise Exception('{} slices have fewer than {} neighbours of other '
+                            'patients in the {} index.'.format(
+                                len(pending), topk, self.index_type))
+
+        return NeighborGraph(db_indices, neighbors, n_rows=len(groups),
+                             groups=groups)
+
+    def get_neighbor_graph(self, topk=TOPK):
+        if self.model_name in RESNET_MODELS or \
+                self.model_name in RESNET_MODELS_ALL or \
+                self.model_name == 'dice':
+            return self.load_neighbor_graph()
+
+        return self.build_neighbor_graph(topk)
+
+    def hubness_report(self, topk=TOPK, n_hubs=N_HUBS, neighbor_graph=None):
+        if neighbor_graph is None:
+            neighbor_graph = self.get_neighbor_graph(topk)
+
+        candidates = neighbor_graph.q_db_indices
+        counts = neighbor_graph.in_degree(topk)[candidates]
+
+        def describe(db_indices):
+            return [{
+                'db_index': int(db_index),
+                'patient_id': self.slice_table.get_patient_id(db_index),
+                'slice_num': int(self.slice_table.slice_num[db_index]),
+            } for db_index in db_indices]
+
+        hubs, hub_counts = neighbor_graph.hubs(topk, n_hubs)
+        hubs = describe(hubs)
+        for hub, count in zip(hubs, hub_counts):
+            hub['k_occurrence'] = int(count)
+
+        antihubs = neighbor_graph.isolated(topk)
+
+        # Rows of patients with fewer than topk slices of other patients
+        # in total; build_neighbor_graph fails on any other short row.
+        n_short = int(np.sum(
+            neighbor_graph.get_valid_mask(topk).sum(axis=1) < topk))
+
+        coverage, n_slices = neighbor_graph.patient_coverage(topk)
+        patient_idx = np.flatnonzero(n_slices > 0)
+
+        return {
+            'dataset_name': self.dataset_name,
+            'model_name': self.model_name,
+            'topk': int(min(topk, neighbor_graph.k)),
+            'n_queries': int(len(candidates)),
+            'n_short_rows': n_short,
+            'k_occurrence': {
+                'mean': float(counts.mean()) if len(counts) > 0 else 0.0,
+                'max': int(counts.max()) if len(counts) > 0 else 0,
+                'skewness': neighbor_graph.skewness(topk),
+                'histogram': neighbor_graph.in_degree_histogram(topk).tolist(),
+            },
+            'hubs': hubs,
+            'antihub_rate': float(len(antihubs) / max(len(candidates), 1)),
+            'antihubs': describe(antihubs),
+            'patient_coverage': {
+                'covered_patient_rate': float(np.mean(coverage[patient_idx] > 0)),
+                'mean_slice_rate': float(np.mean(coverage[patient_idx])),
+                'per_patient': {
+                    self.slice_table.patient_ids[p]: float(coverage[p])
+                    for p in patient_idx
+                },
+            },
+        }
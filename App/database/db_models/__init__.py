@@ -6,3 +6,4 @@ from .retrieved_by_dice import RetrievedByDice
 from .settings import parse_dataset_type
 from .settings import MICCAI_BraTS
 from .settings import DB_TYPE_TO_VECTOR_LENGTH
+from .settings import MODEL_NAMES
@@ -21,6 +21,7 @@ class ImageBase(db.DynamicDocument):
     SLICE_ROOT_DIR_PATH = ""
     NIFTI_ROOT_DIR_PATH = ""
     CODE_ROOT_DIR_PATH = ""
+    CODE_STORES = {}
 
     dataset_type = db.StringField(required=True)
     dataset_name = db.StringField(required=True)
@@ -72,6 +73,14 @@ class ImageBase(db.DynamicDocument):
         cls.NIFTI_ROOT_DIR_PATH = pathlib.Path(NIFTI_ROOT_DIR_PATH)
         cls.CODE_ROOT_DIR_PATH = pathlib.Path(CODE_ROOT_DIR_PATH)
 
+    @classmethod
+    def init_code_store(cls, dataset_name, model_name, code_store):
+        # Keyed by dataset and model and set on the concrete class, so
+        # managers of other datasets or models keep their own stores.
+        code_stores = dict(cls.CODE_STORES)
+        code_stores[(dataset_name, model_name)] = code_store
+        cls.CODE_STORES = code_stores
+
     @classmethod
     def create_record(cls,
                       dataset_name: str,
@@ -98,14 +107,32 @@ class ImageBase(db.DynamicDocument):
 
         return record
 
+    @classmethod
+    def get_next_db_index(cls):
+        record = cls.objects.order_by('-db_index').only('db_index').first()
+        return 0 if record is None else record.db_index + 1
+
     @classmethod
     def get_record_by_db_index(cls, db_index):
         return cls.objects.get(db_index=db_index)
 
+    @classmethod
+    def get_records_by_db_indices(cls, db_indices):
+        db_indices = [int(db_index) for db_index in db_indices]
+        records = {r.db_index: r for r in cls.objects(db_index__in=db_indices)}
+        return [records[db_index] for db_index in db_indices]
+
     @classmethod
     def get_all_records_in_dataset(cls, dataset_name):
         return cls.objects(dataset_name=dataset_name).batch_size(BATCH_SIZE)
 
+    @classmethod
+    def get_slice_table(cls, dataset_name):
+        fields = ['db_index', 'patient_id', 'slice_num',
+                  'is_abnormal', 'is_representative']
+        records = cls.objects(dataset_name=dataset_name).only(*fields)
+        return sorted(records.as_pymongo(), key=itemgetter('db_index'))
+
     @classmethod
     def is_empty_database(cls, dataset_name):
         try:
@@ -203,23 +230,30 @@ class ImageBase(db.DynamicDocument):
 
         return self._code_dir_path
 
+    def get_code(self, code_type, model_name=None):
+        if model_name is None:
+            model_name = self.model_name
+
+        code_store = self.CODE_STORES.get((self.dataset_name, model_name))
+        if code_store is not None:
+            return code_store.get(code_type, self.db_index)
+
+        code_path = self.CODE_ROOT_DIR_PATH / self.dataset_name / \
+            model_name / self.patient_id / \
+            (code_type + '_' + str(self.slice_num).zfill(4) + '.npy')
+        return np.load(code_path).flatten().astype(np.float32)
+
     @property
     def eac(self):
-        code_path = self.code_dir_path / \
-            ('eac_' + str(self.slice_num).zfill(4) + '.npy')
-        return np.load(code_path).flatten().astype(np.float32)
+        return self.get_code('eac')
 
     @property
     def nac(self):
-        code_path = self.code_dir_path / \
-            ('nac_' + str(self.slice_num).zfill(4) + '.npy')
-        return np.load(code_path).flatten().astype(np.float32)
+        return self.get_code('nac')
 
     @property
     def aac(self):
-        code_path = self.code_dir_path / \
-            ('aac_' + str(self.slice_num).zfill(4) + '.npy')
-        return np.load(code_path).flatten().astype(np.float32)
+        return self.get_code('aac')
 
     @property
     def imagenet_feature(self):
@@ -274,39 +308,51 @@ class BraTSImage(ImageBase):
 
         print('Building BraTSImage database...')
         for patient_id in tqdm(os.listdir(dataset_root_path)):
-            patient_dir_path = dataset_root_path / patient_id
-            abnormal_areas = []
-
-            for slice_num in range(cls.n_slices):
-                label_path = patient_dir_path / \
-                    (patient_id + '_seg_' + str(slice_num).zfill(4) + '.npy')
-                label = np.load(label_path).astype(np.int32)
-
-                abnormal_area = (label > 0).sum()
-
-                if abnormal_area > 0:
-                    is_abnormal = True
-                else:
-                    is_abnormal = False
-
-                record = cls.create_record(
-                    dataset_name=dataset_name,
-                    patient_id=patient_id,
-                    slice_num=slice_num,
-                    is_abnormal=is_abnormal,
-                    db_index=db_index,
-                )
-
-                abnormal_areas.append({
-                    'record': record,
-                    'area': abnormal_area,
-                })
-
-                db_index += 1
-
-            abnormal_areas = sorted(abnormal_areas, key=itemgetter('area'))
-            largest_record = abnormal_areas[-1]['record']
-            largest_record.set_as_representative()
+            records = cls.add_patient(dataset_name, patient_id, db_index)
+            db_index += len(records)
+
+    @classmethod
+    def add_patient(cls, dataset_name: str, patient_id: str, db_index: int):
+        # Creates the slice records of one patient with consecutive
+        # db_index values starting at db_index.
+        patient_dir_path = cls.SLICE_ROOT_DIR_PATH / \
+            (dataset_name + SLICE_POSTFIX) / patient_id
+        abnormal_areas = []
+
+        for slice_num in range(cls.n_slices):
+            label_path = patient_dir_path / \
+                (patient_id + '_seg_' + str(slice_num).zfill(4) + '.npy')
+            label = np.load(label_path).astype(np.int32)
+
+            abnormal_area = (label > 0).sum()
+
+            if abnormal_area > 0:
+                is_abnormal = True
+            else:
+                is_abnormal = False
+
+            record = cls.create_record(
+                dataset_name=dataset_name,
+                patient_id=patient_id,
+                slice_num=slice_num,
+                is_abnormal=is_abnormal,
+                db_index=db_index,
+            )
+
+            abnormal_areas.append({
+                'record': record,
+                'area': abnormal_area,
+            })
+
+            db_index += 1
+
+        records = [r['record'] for r in abnormal_areas]
+
+        abnormal_areas = sorted(abnormal_areas, key=itemgetter('area'))
+        largest_record = abnormal_areas[-1]['record']
+        largest_record.set_as_representative()
+
+        return records
 
     @property
     def image(self):
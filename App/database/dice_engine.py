@@ -0,0 +1,107 @@
+import os
+import json
+import pathlib
+import numpy as np
+from tqdm import tqdm
+
+
+MANIFEST_NAME = 'manifest.json'
+DICE_BLOCK_SIZE = 4096
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+
+def popcount_rows(array):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(array).sum(axis=-1, dtype=np.int64)
+
+    return POPCOUNT_TABLE[array].sum(axis=-1, dtype=np.int64)
+
+
+def pack_planes(class_map, classes):
+    class_map = np.asarray(class_map).reshape(-1)
+    return np.stack([np.packbits(class_map == c) for c in classes], axis=0)
+
+
+class DiceEngine(object):
+
+    def __init__(self, planes_dir_path):
+        # Every map is stored as one bit-packed plane per class, so the
+        # per-class intersections of a query with all references reduce
+        # to a bitwise AND followed by a popcount.
+        self.planes_dir_path = pathlib.Path(planes_dir_path)
+
+        with open(self.planes_dir_path / MANIFEST_NAME, 'r') as f:
+            self.manifest = json.load(f)
+
+        self.n_rows = self.manifest['n_rows']
+        self.classes = self.manifest['classes']
+
+        self.planes = np.load(self.planes_dir_path / 'planes.npy',
+                              mmap_mode='r')
+        self.areas = np.load(self.planes_dir_path / 'areas.npy')
+
+    @classmethod
+    def exists(cls, planes_dir_path):
+        return os.path.exists(pathlib.Path(planes_dir_path) / MANIFEST_NAME)
+
+    @classmethod
+    def pack(cls, planes_dir_path, rows, class_maps, n_classes,
+             ignore_index=0):
+        planes_dir_path = pathlib.Path(planes_dir_path)
+        os.makedirs(planes_dir_path, exist_ok=True)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        n_rows = int(rows.max()) + 1
+        classes = [c for c in range(n_classes) if c != ignore_index]
+
+        planes = None
+        areas = np.zeros((len(classes), n_rows), dtype=np.int64)
+
+        print('Packing dice planes in {}.'.format(planes_dir_path))
+        for row, class_map in zip(tqdm(rows), class_maps):
+            packed = pack_planes(class_map, classes)
+
+            if planes is None:
+                planes = np.lib.format.open_memmap(
+                    planes_dir_path / 'planes.npy',
+                    mode='w+',
+                    dtype=np.uint8,
+                    shape=(len(classes), n_rows, packed.shape[1]),
+                )
+
+            planes[:, row] = packed
+            areas[:, row] = popcount_rows(packed)
+
+        planes.flush()
+        del planes
+
+        np.save(planes_dir_path / 'areas.npy', areas)
+
+        with open(planes_dir_path / MANIFEST_NAME, 'w') as f:
+            json.dump({'n_rows': n_rows, 'classes': classes}, f)
+
+        return cls(planes_dir_path)
+
+    def __len__(self):
+        return self.n_rows
+
+    def query(self, row, block_size=DICE_BLOCK_SIZE, eps=1e-5):
+        return self.query_planes(
+            np.array(self.planes[:, row]), self.areas[:, row],
+            block_size=block_size, eps=eps)
+
+    def query_planes(self, q_planes, q_areas, block_size=DICE_BLOCK_SIZE,
+                     eps=1e-5):
+        # Mean dice over the non-ignored classes, identical to calc_dice.
+        dice = np.zeros(self.n_rows, dtype=np.float64)
+
+        for i in range(len(self.classes)):
+            for start in range(0, self.n_rows, block_size):
+                stop = min(start + block_size, self.n_rows)
+                inter = popcount_rows(
+                    np.bitwise_and(self.planes[i, start:stop], q_planes[i]))
+                union = self.areas[i, start:stop] + q_areas[i]
+                dice[start:stop] += 2.0 * inter / (union + eps)
+
+        return dice / len(self.classes)
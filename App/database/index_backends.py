@@ -0,0 +1,384 @@
+import time
+import numpy as np
+from tqdm import tqdm
+from annoy import AnnoyIndex
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+QUERY_BLOCK_SIZE = 256
+N_QUERY_THREADS = 8
+HNSW_ADD_BLOCK_SIZE = 4096
+
+
+class IndexBackend(object):
+
+    # Common interface of the search indexes. ids are the db_indices of
+    # the rows passed to build, and query/query_batch return numpy arrays
+    # of (ids, euclidean distances) sorted by distance.
+    uses_rerank_matrix = False
+
+    def __init__(self, vector_length, metric='euclidean'):
+        assert metric == 'euclidean'
+
+        self.vector_length = vector_length
+        self.metric = metric
+
+    def get_params(self):
+        # Build-time parameters, recorded in the manifest of a saved index.
+        return {}
+
+    def get_file_name(self, prefix):
+        # None for indexes that are rebuilt on every start.
+        return None
+
+    def build(self, ids, matrix, path=None):
+        raise NotImplementedError
+
+    def save(self, path):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+    def unload(self):
+        pass
+
+    def get_n_items(self):
+        raise NotImplementedError
+
+    def query(self, vector, topk):
+        raise NotImplementedError
+
+    def query_batch(self, queries, topk, **kwargs):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+        topk = min(topk, self.get_n_items())
+
+        ids = np.full((len(queries), topk), -1, dtype=np.int64)
+        distances = np.full((len(queries), topk), np.inf, dtype=np.float32)
+
+        for i, query in enumerate(queries):
+            q_ids, q_distances = self.query(query, topk, **kwargs)
+            ids[i, :len(q_ids)] = q_ids
+            distances[i, :len(q_distances)] = q_distances
+
+        return ids, distances
+
+
+class ExactIndex(IndexBackend):
+
+    def __init__(self, vector_length, metric='euclidean'):
+        super().__init__(vector_length, metric)
+
+        self.ids = None
+        self.matrix = None
+        self.sq_norms = None
+
+    def add_items(self, ids, matrix):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        assert matrix.ndim == 2 and matrix.shape[1] == self.vector_length
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = matrix
+        self.sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+
+    def build(self, ids, matrix, path=None):
+        self.add_items(ids, matrix)
+
+    def save(self, path):
+        # get_file_name returns None, so DatabaseManager never saves this
+        # index and rebuilds it from the code store on start instead; the
+        # file is for standalone use.
+        with open(str(path), 'wb') as f:
+            np.savez(f, ids=self.ids, matrix=self.matrix)
+
+    def load(self, path):
+        with np.load(str(path)) as data:
+            self.add_items(data['ids'], data['matrix'])
+
+    def get_n_items(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def _sq_distances(self, vector):
+        # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2
+        sq_distances = self.sq_norms - 2.0 * (self.matrix @ vector)
+        sq_distances += np.dot(vector, vector)
+        return sq_distances
+
+    def query_all(self, vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        sq_distances = self._sq_distances(vector)
+        return self.ids, np.sqrt(np.maximum(sq_distances, 0.0))
+
+    def query(self, vector, topk):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        topk = min(topk, self.get_n_items())
+
+        sq_distances = self._sq_distances(vector)
+
+        if topk < len(sq_distances):
+            nearest = np.argpartition(sq_distances, topk - 1)[:topk]
+        else:
+            nearest = np.arange(len(sq_distances))
+
+        nearest = nearest[np.argsort(sq_distances[nearest], kind='stable')]
+        distances = np.sqrt(np.maximum(sq_distances[nearest], 0.0))
+
+        return self.ids[nearest], distances
+
+    def query_batch(self, queries, topk, block_size=QUERY_BLOCK_SIZE):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+        topk = min(topk, self.get_n_items())
+
+        ids = np.empty((len(queries), topk), dtype=np.int64)
+        distances = np.empty((len(queries), topk), dtype=np.float32)
+
+        # Queries are processed in blocks so that the (block, n_items)
+        # distance tile stays bounded regardless of the number of queries.
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+
+            sq_distances = block @ self.matrix.T
+            sq_distances *= -2.0
+            sq_distances += self.sq_norms[np.newaxis, :]
+            sq_distances += np.einsum('ij,ij->i', block, block)[:, np.newaxis]
+
+            if topk < sq_distances.shape[1]:
+                nearest = np.argpartition(
+                    sq_distances, topk - 1, axis=1)[:, :topk]
+            else:
+                nearest = np.tile(np.arange(sq_distances.shape[1]),
+                                  (len(block), 1))
+
+            nearest_sq = np.take_along_axis(sq_distances, nearest, axis=1)
+            order = np.argsort(nearest_sq, axis=1, kind='stable')
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            nearest_sq = np.take_along_axis(nearest_sq, order, axis=1)
+
+            ids[start:start + len(block)] = self.ids[nearest]
+            distances[start:start + len(block)] = \
+                np.sqrt(np.maximum(nearest_sq, 0.0))
+
+        return ids, distances
+
+
+class AnnoyBackend(IndexBackend):
+
+    def __init__(self,
+                 vector_length,
+                 metric='euclidean',
+                 n_trees=10,
+                 n_jobs=-1,
+                 on_disk_build=False,
+                 search_k=-1,
+                 n_threads=N_QUERY_THREADS):
+        super().__init__(vector_length, metric)
+
+        self.n_trees = n_trees
+        self.n_jobs = n_jobs
+        self.on_disk_build = on_disk_build
+        self.search_k = search_k
+        self.n_threads = n_threads
+
+        self.model = None
+        self.on_disk_path = None
+
+    def get_params(self):
+        return {'n_trees': self.n_trees}
+
+    def get_file_name(self, prefix):
+        return prefix + '-n-' + str(self.n_trees) + '.ann'
+
+    def build(self, ids, matrix, path=None):
+        self.model = AnnoyIndex(self.vector_length, self.metric)
+
+        # With on_disk_build the index is built directly in its file, so
+        # it never has to fit in RAM and does not need to be saved.
+        if self.on_disk_build and path is not None:
+            self.model.on_disk_build(str(path))
+            self.on_disk_path = str(path)
+
+        for item_id, vector in zip(tqdm(ids), matrix):
+            self.model.add_item(int(item_id), vector)
+
+        self.model.build(self.n_trees, n_jobs=self.n_jobs)
+
+    def save(self, path):
+        if self.on_disk_path != str(path):
+            self.model.save(str(path))
+
+    def load(self, path):
+        self.model = AnnoyIndex(self.vector_length, self.metric)
+        self.model.load(str(path))
+        self.on_disk_path = None
+
+    def unload(self):
+        self.model.unload()
+
+    def get_n_items(self):
+        return self.model.get_n_items()
+
+    def query(self, vector, topk, search_k=None):
+        if search_k is None:
+            search_k = self.search_k
+
+        ids, distances = self.model.get_nns_by_vector(
+            vector, topk, search_k=search_k, include_distances=True)
+
+        return np.asarray(ids, dtype=np.int64), \
+            np.asarray(distances, dtype=np.float32)
+
+    def query_batch(self, queries, topk, search_k=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+
+        ids = np.full((len(queries), topk), -1, dtype=np.int64)
+        distances = np.full((len(queries), topk), np.inf, dtype=np.float32)
+
+        # Annoy releases the GIL while searching, so the lookups of
+        # different queries run in parallel on a thread pool.
+        def search(query):
+            return self.query(query, topk, search_k=search_k)
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for i, (q_ids, q_distances) in enumerate(
+                    executor.map(search, queries)):
+                ids[i, :len(q_ids)] = q_ids
+                distances[i, :len(q_distances)] = q_distances
+
+        return ids, distances
+
+
+class HNSWBackend(IndexBackend):
+
+    def __init__(self,
+                 vector_length,
+                 metric='euclidean',
+                 m=16,
+                 ef_construction=200,
+                 ef_search=100,
+                 n_threads=-1):
+        super().__init__(vector_length, metric)
+
+        try:
+            assert hnswlib is not None
+        except Exception:
+            raise Exception('hnswlib is required for the hnsw index.')
+
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.n_threads = n_threads
+
+        self.model = None
+
+    def get_params(self):
+        return {'m': self.m, 'ef_construction': self.ef_construction}
+
+    def get_file_name(self, prefix):
+        return prefix + '-hnsw-m-' + str(self.m) \
+            + '-ef-' + str(self.ef_construction) + '.bin'
+
+    def build(self, ids, matrix, path=None):
+        self.model = hnswlib.Index(space='l2', dim=self.vector_length)
+        self.model.init_index(max_elements=len(ids),
+                              ef_construction=self.ef_construction,
+                              M=self.m)
+
+        ids = np.asarray(ids, dtype=np.int64)
+        for start in tqdm(range(0, len(ids), HNSW_ADD_BLOCK_SIZE)):
+            stop = min(start + HNSW_ADD_BLOCK_SIZE, len(ids))
+            self.model.add_items(
+                np.asarray(matrix[start:stop], dtype=np.float32),
+                ids[start:stop], num_threads=self.n_threads)
+
+    def save(self, path):
+        self.model.save_index(str(path))
+
+    def load(self, path):
+        self.model = hnswlib.Index(space='l2', dim=self.vector_length)
+        self.model.load_index(str(path))
+
+    def get_n_items(self):
+        return self.model.get_current_count()
+
+    def query(self, vector, topk, ef_search=None):
+        ids, distances = self.query_batch(
+            np.asarray(vector, dtype=np.float32).reshape(1, -1), topk,
+            ef_search=ef_search, n_threads=1)
+
+        return ids[0], distances[0]
+
+    def query_batch(self, queries, topk, ef_search=None, n_threads=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+        topk = min(topk, self.get_n_items())
+
+        if ef_search is None:
+            ef_search = self.ef_search
+
+        if n_threads is None:
+            n_threads = self.n_threads
+
+        # ef has to be at least k for hnswlib to return k neighbours.
+        self.model.set_ef(max(ef_search, topk))
+        ids, sq_distances = self.model.knn_query(
+            queries, k=topk, num_threads=n_threads)
+
+        return ids.astype(np.int64), \
+            np.sqrt(np.maximum(sq_distances, 0.0)).astype(np.float32)
+
+
+def merge_results(ids, distances, other_ids, other_distances, topk):
+    # Merges the results of two indexes for one query. An id present in
+    # both (e.g. while a compaction is being swapped in) is kept once.
+    ids = np.concatenate([ids, other_ids]).astype(np.int64)
+    distances = np.concatenate([distances, other_distances]).astype(np.float32)
+
+    order = np.argsort(distances, kind='stable')
+    ids = ids[order]
+    distances = distances[order]
+
+    _, first = np.unique(ids, return_index=True)
+    first = np.sort(first)[:topk]
+
+    return ids[first], distances[first]
+
+
+def compare_indexes(exact_index, query_fns, queries, topk):
+    exact_results = []
+    exact_latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        ids, _ = exact_index.query(query, topk)
+        exact_latencies.append(time.perf_counter() - start)
+        exact_results.append(set(ids.tolist()))
+
+    report = {'exact': {
+        'recall': 1.0,
+        'mean_latency_ms': 1e3 * float(np.mean(exact_latencies)),
+        'p95_latency_ms': 1e3 * float(np.percentile(exact_latencies, 95)),
+    }}
+
+    for name, query_fn in query_fns.items():
+        recalls = []
+        latencies = []
+        for query, exact_ids in zip(queries, exact_results):
+            start = time.perf_counter()
+            ids = query_fn(query, topk)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len(exact_ids & set(ids)) / len(exact_ids))
+
+        report[name] = {
+            'recall': float(np.mean(recalls)),
+            'mean_latency_ms': 1e3 * float(np.mean(latencies)),
+            'p95_latency_ms': 1e3 * float(np.percentile(latencies, 95)),
+        }
+
+    return report
@@ -0,0 +1,313 @@
+import os
+import json
+import mmap
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+
+
+KNN_BLOCK_SIZE = 1024
+
+_knn_worker_state = {}
+
+
+def knn_block(matrix, sq_norms, groups, start, stop, topk):
+    # Distances of rows start:stop to all rows with a single GEMM. Pairs
+    # that share a group (patient) get an infinite distance; they fill up
+    # the lists of rows with fewer than topk rows in other groups and have
+    # to be dropped by the caller.
+    n_rows = len(matrix)
+    block = np.asarray(matrix[start:stop], dtype=np.float32)
+
+    sq_distances = block @ np.asarray(matrix, dtype=np.float32).T
+    sq_distances *= -2.0
+    sq_distances += sq_norms[np.newaxis, :]
+    sq_distances += sq_norms[start:stop, np.newaxis]
+    sq_distances[groups[start:stop, np.newaxis] == groups[np.newaxis, :]] = np.inf
+
+    k = min(topk, n_rows)
+    if k < n_rows:
+        nearest = np.argpartition(sq_distances, k - 1, axis=1)[:, :k]
+    else:
+        nearest = np.tile(np.arange(n_rows), (stop - start, 1))
+
+    nearest_sq = np.take_along_axis(sq_distances, nearest, axis=1)
+    order = np.argsort(nearest_sq, axis=1, kind='stable')
+    nearest = np.take_along_axis(nearest, order, axis=1)
+    nearest_sq = np.take_along_axis(nearest_sq, order, axis=1)
+
+    return start, nearest, np.sqrt(np.maximum(nearest_sq, 0.0))
+
+
+def blocked_knn(matrix, groups, topk, block_size=KNN_BLOCK_SIZE, skip_blocks=()):
+    # All-pairs k-NN over the rows of matrix, one (block_size, n_rows)
+    # tile at a time.
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    groups = np.asarray(groups)
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+
+    skip_blocks = set(skip_blocks)
+
+    for start in range(0, len(matrix), block_size):
+        if start in skip_blocks:
+            continue
+
+        yield knn_block(matrix, sq_norms, groups, start,
+                        min(start + block_size, len(matrix)), topk)
+
+
+class SharedArrays(object):
+
+    def __init__(self, arrays):
+        # Publishes arrays to worker processes once. Whole memory-mapped
+        # .npy files are shared by path, anything else is copied a single
+        # time into a shared memory segment; workers attach without copying.
+        self.specs = {}
+        self.segments = []
+
+        for key, array in arrays.items():
+            # Views of a memmap report the offset of the whole file, so
+            # only the mapping itself is shared by path.
+            if isinstance(array, np.memmap) and \
+                    isinstance(array.base, mmap.mmap):
+                self.specs[key] = ('memmap', array.filename, array.offset,
+                                   array.shape, array.dtype.str)
+                continue
+
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(
+                create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=segment.buf)[...] = array
+
+            self.segments.append(segment)
+            self.specs[key] = ('shm', segment.name, 0,
+                               array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(specs):
+        arrays = {}
+        segments = []
+
+        for key, (kind, name, offset, shape, dtype) in specs.items():
+            if kind == 'memmap':
+                arrays[key] = np.memmap(name, dtype=dtype, mode='r',
+                                        offset=offset, shape=shape)
+            else:
+                segment = shared_memory.SharedMemory(name=name)
+                segments.append(segment)
+                arrays[key] = np.ndarray(shape, dtype=dtype,
+                                         buffer=segment.buf)
+
+        return arrays, segments
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+
+        self.segments = []
+
+
+def _init_knn_worker(specs, topk):
+    arrays, segments = SharedArrays.attach(specs)
+    _knn_worker_state.update(arrays)
+    _knn_worker_state['segments'] = segments
+    _knn_worker_state['topk'] = topk
+
+
+def _knn_worker(block):
+    return knn_block(_knn_worker_state['matrix'],
+                     _knn_worker_state['sq_norms'],
+                     _knn_worker_state['groups'],
+                     block[0], block[1],
+                     _knn_worker_state['topk'])
+
+
+def parallel_blocked_knn(matrix,
+                         groups,
+                         topk,
+                         n_processes,
+                         block_size=KNN_BLOCK_SIZE,
+                         skip_blocks=()):
+    # Same results as blocked_knn, with contiguous row blocks spread over
+    # worker processes that share one copy of the reference matrix.
+    if n_processes is None or n_processes <= 1:
+        yield from blocked_knn(matrix, groups, topk, block_size, skip_blocks)
+        return
+
+    if not (isinstance(matrix, np.memmap) and matrix.dtype == np.float32):
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    groups = np.asarray(groups)
+
+    sq_norms = np.zeros(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    skip_blocks = set(skip_blocks)
+    blocks = [
+        (start, min(start + block_size, len(matrix)))
+        for start in range(0, len(matrix), block_size)
+        if start not in skip_blocks
+    ]
+
+    shared = SharedArrays({
+        'matrix': matrix,
+        'sq_norms': sq_norms,
+        'groups': groups,
+    })
+
+    try:
+        with Pool(processes=n_processes,
+                  initializer=_init_knn_worker,
+                  initargs=(shared.specs, topk)) as pool:
+            # imap keeps block order, so progress is marked in sequence.
+            yield from pool.imap(_knn_worker, blocks)
+
+    finally:
+        shared.close()
+
+
+class KnnProgress(object):
+
+    def __init__(self, progress_path, params):
+        self.progress_path = progress_path
+        self.params = params
+        self.completed_blocks = []
+
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r') as f:
+                progress = json.load(f)
+
+            if progress['params'] == self.params:
+                self.completed_blocks = progress['completed_blocks']
+
+    def mark(self, start):
+        self.completed_blocks.append(int(start))
+
+        os.makedirs(os.path.dirname(self.progress_path), exist_ok=True)
+        with open(self.progress_path, 'w') as f:
+            json.dump({
+                'params': self.params,
+                'completed_blocks': self.completed_blocks,
+            }, f)
+
+
+class NeighborGraph(object):
+
+    def __init__(self, q_db_indices, neighbors, n_rows, groups=None):
+        # neighbors[i] holds the db_indices retrieved for q_db_indices[i],
+        # padded with -1 when a list is shorter than the others. Edges
+        # between slices of the same group (patient) are not counted.
+        self.q_db_indices = np.asarray(q_db_indices, dtype=np.int64)
+        self.neighbors = np.asarray(neighbors, dtype=np.int64)
+        self.n_rows = n_rows
+        self.groups = groups
+
+    @classmethod
+    def from_lists(cls, q_db_indices, neighbor_lists, n_rows, groups=None):
+        k = max([len(n) for n in neighbor_lists] + [0])
+        neighbors = np.full((len(neighbor_lists), k), -1, dtype=np.int64)
+
+        for i, neighbor_list in enumerate(neighbor_lists):
+            neighbors[i, :len(neighbor_list)] = neighbor_list
+
+        return cls(q_db_indices, neighbors, n_rows, groups=groups)
+
+    def __len__(self):
+        return len(self.q_db_indices)
+
+    @property
+    def k(self):
+        return self.neighbors.shape[1]
+
+    def get_neighbors(self, topk=None):
+        return self.neighbors if topk is None else self.neighbors[:, :topk]
+
+    def get_valid_mask(self, topk=None):
+        neighbors = self.get_neighbors(topk)
+        valid = neighbors >= 0
+
+        if self.groups is not None:
+            valid &= self.groups[np.where(valid, neighbors, 0)] != \
+                self.groups[self.q_db_indices][:, np.newaxis]
+
+        return valid
+
+    def in_degree(self, topk=None):
+        neighbors = self.get_neighbors(topk)
+        valid = self.get_valid_mask(topk)
+        return np.bincount(neighbors[valid], minlength=self.n_rows)
+
+    def compact(self, topk):
+        # Keeps the first topk neighbours of each row that survive the
+        # group filter, so over-fetched index results become plain
+        # cross-patient k-NN lists.
+        valid = self.get_valid_mask()
+        order = np.argsort(~valid, axis=1, kind='stable')[:, :topk]
+
+        neighbors = np.take_along_axis(self.neighbors, order, axis=1)
+        neighbors[~np.take_along_axis(valid, order, axis=1)] = -1
+
+        return NeighborGraph(self.q_db_indices, neighbors, self.n_rows,
+                             groups=self.groups)
+
+    def isolated(self, topk=None, candidates=None):
+        in_degree = self.in_degree(topk)
+
+        if candidates is None:
+            candidates = self.q_db_indices
+
+        candidates = np.asarray(candidates, dtype=np.int64)
+        return candidates[in_degree[candidates] == 0]
+
+    def in_degree_histogram(self, topk=None, candidates=None):
+        in_degree = self.in_degree(topk)
+
+        if candidates is None:
+            candidates = self.q_db_indices
+
+        return np.bincount(in_degree[np.asarray(candidates, dtype=np.int64)])
+
+    def skewness(self, topk=None, candidates=None):
+        # Skewness of the k-occurrence distribution; large positive values
+        # mean a few hub slices appear in most of the neighbour lists.
+        if candidates is None:
+            candidates = self.q_db_indices
+
+        counts = self.in_degree(topk)[np.asarray(candidates, dtype=np.int64)]
+        counts = counts.astype(np.float64)
+        std = counts.std()
+
+        if std == 0:
+            return 0.0
+
+        return float(np.mean((counts - counts.mean()) ** 3) / std ** 3)
+
+    def hubs(self, topk=None, n_hubs=10, candidates=None):
+        if candidates is None:
+            candidates = self.q_db_indices
+
+        candidates = np.asarray(candidates, dtype=np.int64)
+        counts = self.in_degree(topk)[candidates]
+        order = np.argsort(-counts, kind='stable')[:n_hubs]
+
+        return candidates[order], counts[order]
+
+    def patient_coverage(self, topk=None, candidates=None):
+        # Fraction of the slices of every patient that occur in at least
+        # one neighbour list, indexed by group (patient_idx).
+        if candidates is None:
+            candidates = self.q_db_indices
+
+        candidates = np.asarray(candidates, dtype=np.int64)
+        groups = self.groups[candidates]
+        covered = self.in_degree(topk)[candidates] > 0
+
+        n_slices = np.bincount(groups)
+        n_covered = np.bincount(groups, weights=covered,
+                                minlength=len(n_slices))
+
+        return n_covered / np.maximum(n_slices, 1), n_slices
@@ -0,0 +1,103 @@
+import numpy as np
+
+from .index_backends import ExactIndex
+
+
+PATIENT_AGGREGATIONS = {'mean', 'max', 'representative'}
+# Candidate patients per requested patient. Each candidate costs all of
+# its slices (155 on BraTS), so topk_patient=10 reranks 20 patients or
+# about 6% of the 51925 BraTS slices.
+COARSE_CANDIDATE_FACTOR = 2
+
+
+class PatientIndex(object):
+
+    def __init__(self, slice_table, db_indices, matrix, aggregation='mean'):
+        assert aggregation in PATIENT_AGGREGATIONS
+
+        self.slice_table = slice_table
+        self.aggregation = aggregation
+
+        self.db_indices = np.asarray(db_indices, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+        # Rows are grouped by patient so that the slices of any patient
+        # are a contiguous range of self.order.
+        row_patient_idx = slice_table.patient_idx[self.db_indices]
+        self.order = np.argsort(row_patient_idx, kind='stable')
+        self.offsets = np.searchsorted(
+            row_patient_idx[self.order], np.arange(slice_table.n_patients + 1))
+
+        self.coarse_model = ExactIndex(self.matrix.shape[1])
+        self.coarse_model.add_items(*self.aggregate(row_patient_idx))
+
+    def aggregate(self, row_patient_idx):
+        patient_idx = np.flatnonzero(np.diff(self.offsets) > 0)
+        starts = self.offsets[patient_idx]
+        sorted_matrix = self.matrix[self.order]
+
+        if self.aggregation == 'mean':
+            counts = np.diff(self.offsets)[patient_idx]
+            codes = np.add.reduceat(sorted_matrix, starts, axis=0)
+            codes /= counts[:, np.newaxis]
+
+        elif self.aggregation == 'max':
+            codes = np.maximum.reduceat(sorted_matrix, starts, axis=0)
+
+        else:
+            rows = np.flatnonzero(
+                self.slice_table.is_representative[self.db_indices])
+            patient_idx = row_patient_idx[rows]
+            codes = self.matrix[rows]
+
+        return patient_idx, codes
+
+    def get_n_items(self):
+        return self.coarse_model.get_n_items()
+
+    def get_patient_rows(self, patient_idx):
+        return np.concatenate([
+            self.order[self.offsets[p]:self.offsets[p + 1]]
+            for p in patient_idx
+        ])
+
+    def get_candidates(self,
+                       vector,
+                       topk_patient,
+                       n_candidates=None,
+                       exclude_patient_idx=None):
+        if n_candidates is None:
+            n_candidates = COARSE_CANDIDATE_FACTOR * topk_patient
+
+        n_candidates = max(n_candidates, topk_patient)
+
+        if exclude_patient_idx is not None:
+            n_candidates += 1
+
+        candidates, _ = self.coarse_model.query(vector, n_candidates)
+        return candidates
+
+    def query(self,
+              vector,
+              topk_patient,
+              n_candidates=None,
+              exclude_patient_idx=None,
+              exclude_db_index=None):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+
+        candidates = self.get_candidates(
+            vector, topk_patient, n_candidates, exclude_patient_idx)
+
+        rows = self.get_patient_rows(candidates)
+        sq_distances = self.sq_norms[rows] - 2.0 * (self.matrix[rows] @ vector)
+        sq_distances += np.dot(vector, vector)
+        distances = np.sqrt(np.maximum(sq_distances, 0.0))
+
+        db_indices = self.db_indices[rows]
+        positions = self.slice_table.min_per_patient(
+            db_indices, distances, topk=topk_patient,
+            exclude_patient_idx=exclude_patient_idx,
+            exclude_db_index=exclude_db_index)
+
+        return db_indices[positions], distances[positions]
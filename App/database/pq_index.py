@@ -0,0 +1,261 @@
+import numpy as np
+from tqdm import tqdm
+
+from .index_backends import IndexBackend
+
+
+PQ_N_SUBVECTORS = 64
+PQ_N_CENTROIDS = 256
+PQ_N_RERANK = 100
+PQ_N_TRAIN = 65536
+PQ_BLOCK_SIZE = 65536
+
+
+def nearest_centroids(x, centroids, block_size=PQ_BLOCK_SIZE):
+    c_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assign = np.empty(len(x), dtype=np.int64)
+
+    for start in range(0, len(x), block_size):
+        block = x[start:start + block_size]
+        sq_distances = c_sq_norms[np.newaxis, :] - 2.0 * (block @ centroids.T)
+        assign[start:start + len(block)] = np.argmin(sq_distances, axis=1)
+
+    return assign
+
+
+def kmeans(x, n_clusters, n_iter, rng, centroids=None):
+    if centroids is None:
+        centroids = x[rng.choice(len(x), n_clusters,
+                                 replace=len(x) < n_clusters)].copy()
+
+    for _ in range(n_iter):
+        assign = nearest_centroids(x, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+
+        # Empty clusters are reseeded with random training points.
+        n_empty = int(np.sum(~filled))
+        if n_empty > 0:
+            centroids[~filled] = x[rng.choice(len(x), n_empty)]
+
+    return centroids
+
+
+class PQIndex(IndexBackend):
+
+    uses_rerank_matrix = True
+
+    def __init__(self,
+                 vector_length,
+                 metric='euclidean',
+                 n_subvectors=PQ_N_SUBVECTORS,
+                 n_centroids=PQ_N_CENTROIDS,
+                 use_opq=False,
+                 n_rerank=PQ_N_RERANK):
+        # Every vector is split into n_subvectors chunks and each chunk is
+        # replaced by the id of its nearest centroid, so a 2048-d float32
+        # code shrinks to n_subvectors bytes. Queries are scored against
+        # the compressed codes with per-chunk distance tables (ADC) and
+        # the best n_rerank candidates are rescored exactly.
+        super().__init__(vector_length, metric)
+
+        assert vector_length % n_subvectors == 0
+        assert n_centroids <= 256
+
+        self.n_subvectors = n_subvectors
+        self.n_centroids = n_centroids
+        self.sub_length = vector_length // n_subvectors
+        self.use_opq = use_opq
+        self.n_rerank = n_rerank
+
+        self.rotation = None
+        self.codebooks = None
+        self.ids = None
+        self.codes = None
+        self.rerank_matrix = None
+
+    def get_params(self):
+        return {'n_subvectors': self.n_subvectors, 'use_opq': self.use_opq}
+
+    def get_file_name(self, prefix):
+        return prefix + ('-opq-m-' if self.use_opq else '-pq-m-') \
+            + str(self.n_subvectors) + '.npz'
+
+    def _split(self, x):
+        return x.reshape(len(x), self.n_subvectors, self.sub_length)
+
+    def _rotate(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return x if self.rotation is None else x @ self.rotation
+
+    def _train_codebooks(self, x, n_iter, rng):
+        sub_x = self._split(x)
+        codebooks = np.empty(
+            (self.n_subvectors, self.n_centroids, self.sub_length),
+            dtype=np.float32)
+
+        for m in range(self.n_subvectors):
+            codebooks[m] = kmeans(
+                np.ascontiguousarray(sub_x[:, m]), self.n_centroids, n_iter,
+                rng, centroids=None if self.codebooks is None
+                else self.codebooks[m].copy())
+
+        self.codebooks = codebooks
+
+    def train(self, matrix, n_train=PQ_N_TRAIN, n_iter=20, n_opq_iter=5,
+              seed=0):
+        rng = np.random.RandomState(seed)
+        rows = np.sort(rng.choice(len(matrix), min(n_train, len(matrix)),
+                                  replace=False))
+        x = np.asarray(matrix[rows], dtype=np.float32)
+
+        if not self.use_opq:
+            self._train_codebooks(x, n_iter, rng)
+            return
+
+        # OPQ: alternate between codebooks for the rotated data and the
+        # orthogonal rotation that best maps the data onto its
+        # reconstruction (orthogonal Procrustes).
+        self.rotation = np.eye(self.vector_length, dtype=np.float32)
+
+        for _ in tqdm(range(n_opq_iter)):
+            self._train_codebooks(x @ self.rotation,
+                                  max(n_iter // n_opq_iter, 2), rng)
+            y = self.decode(self.encode(x))
+
+            u, _, vt = np.linalg.svd(x.T @ y)
+            self.rotation = (u @ vt).astype(np.float32)
+
+        self._train_codebooks(x @ self.rotation, n_iter, rng)
+
+    def encode(self, matrix, block_size=PQ_BLOCK_SIZE):
+        codes = np.empty((len(matrix), self.n_subvectors), dtype=np.uint8)
+
+        for start in range(0, len(matrix), block_size):
+            sub_x = self._split(self._rotate(matrix[start:start + block_size]))
+
+            for m in range(self.n_subvectors):
+                codes[start:start + len(sub_x), m] = nearest_centroids(
+                    np.ascontiguousarray(sub_x[:, m]), self.codebooks[m])
+
+        return codes
+
+    def decode(self, codes):
+        # Reconstruction in the rotated space.
+        return self.codebooks[np.arange(self.n_subvectors), codes].reshape(
+            len(codes), self.vector_length)
+
+    def build(self, ids, matrix, path=None):
+        self.train(matrix)
+        self.add_items(ids, matrix)
+
+    def add_items(self, ids, matrix):
+        assert self.codebooks is not None
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.codes = self.encode(matrix)
+        self.set_rerank_matrix(matrix)
+
+    def set_rerank_matrix(self, matrix):
+        # Rows aligned with self.ids, typically the memory-mapped store.
+        self.rerank_matrix = matrix
+
+    def get_n_items(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def adc_sq_distances(self, vector, block_size=PQ_BLOCK_SIZE):
+        sub_q = self._rotate(vector.reshape(1, -1)).reshape(
+            self.n_subvectors, 1, self.sub_length)
+        tables = np.sum((self.codebooks - sub_q) ** 2, axis=2)
+
+        offsets = np.arange(self.n_subvectors) * self.n_centroids
+        tables = tables.ravel()
+
+        sq_distances = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), block_size):
+            codes = self.codes[start:start + block_size].astype(np.int64)
+            sq_distances[start:start + len(codes)] = \
+                tables[codes + offsets].sum(axis=1)
+
+        return sq_distances
+
+    def query(self, vector, topk, n_rerank=None):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        n_items = self.get_n_items()
+        topk = min(topk, n_items)
+
+        if n_rerank is None:
+            n_rerank = self.n_rerank
+
+        n_candidates = min(max(n_rerank, topk), n_items)
+        sq_distances = self.adc_sq_distances(vector)
+
+        if n_candidates < n_items:
+            candidates = np.argpartition(sq_distances, n_candidates - 1)
+            candidates = candidates[:n_candidates]
+        else:
+            candidates = np.arange(n_items)
+
+        if self.rerank_matrix is not None and n_rerank > 0:
+            # Sorted rows keep the reads from the memmap sequential.
+            candidates = np.sort(candidates)
+            rows = np.asarray(self.rerank_matrix[candidates], dtype=np.float32)
+            sq_distances = np.sum((rows - vector) ** 2, axis=1)
+        else:
+            sq_distances = sq_distances[candidates]
+
+        nearest = np.argsort(sq_distances, kind='stable')[:topk]
+        distances = np.sqrt(np.maximum(sq_distances[nearest], 0.0))
+
+        return self.ids[candidates[nearest]], distances
+
+    def query_batch(self, queries, topk, n_rerank=None):
+        queries = np.asarray(queries, dtype=np.float32)
+        queries = queries.reshape(len(queries), -1)
+        topk = min(topk, self.get_n_items())
+
+        ids = np.empty((len(queries), topk), dtype=np.int64)
+        distances = np.empty((len(queries), topk), dtype=np.float32)
+
+        for i, query in enumerate(queries):
+            ids[i], distances[i] = self.query(query, topk, n_rerank=n_rerank)
+
+        return ids, distances
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                params=np.array([self.vector_length, self.n_subvectors,
+                                 self.n_centroids, int(self.use_opq),
+                                 self.n_rerank]),
+                rotation=np.zeros((0, 0), dtype=np.float32)
+                if self.rotation is None else self.rotation,
+                codebooks=self.codebooks,
+                ids=self.ids,
+                codes=self.codes,
+            )
+
+    def load(self, path):
+        # n_rerank is a query-time setting and is kept as configured.
+        with np.load(path) as data:
+            vector_length, n_subvectors, n_centroids, use_opq, _ = \
+                data['params'].tolist()
+
+            assert vector_length == self.vector_length
+
+            self.n_subvectors = n_subvectors
+            self.n_centroids = n_centroids
+            self.sub_length = vector_length // n_subvectors
+            self.use_opq = bool(use_opq)
+            self.rotation = data['rotation'] \
+                if data['rotation'].size > 0 else None
+
+            self.codebooks = data['codebooks']
+            self.ids = data['ids']
+            self.codes = data['codes']
@@ -0,0 +1,97 @@
+import numpy as np
+from tqdm import tqdm
+
+
+PROJECTION_BLOCK_SIZE = 4096
+
+
+class PCAProjection(object):
+
+    def __init__(self, n_components, whiten=False, eps=1e-6):
+        self.n_components = n_components
+        self.whiten = whiten
+        self.eps = eps
+
+        self.mean = None
+        self.components = None
+        self.explained_variance = None
+        self.total_variance = None
+
+    def fit(self, matrix, block_size=PROJECTION_BLOCK_SIZE):
+        # The mean and the scatter matrix are accumulated block by block,
+        # so the reference matrix can stay memory-mapped.
+        n_rows, vector_length = matrix.shape
+        assert self.n_components <= vector_length
+
+        total = np.zeros(vector_length, dtype=np.float64)
+        scatter = np.zeros((vector_length, vector_length), dtype=np.float64)
+
+        print('Fitting PCA with {} components.'.format(self.n_components))
+        for start in tqdm(range(0, n_rows, block_size)):
+            block = np.asarray(matrix[start:start + block_size],
+                               dtype=np.float64)
+            total += block.sum(axis=0)
+            scatter += block.T @ block
+
+        mean = total / n_rows
+        covariance = scatter / n_rows - np.outer(mean, mean)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+
+        self.mean = mean.astype(np.float32)
+        self.components = eigenvectors[:, order].T.astype(np.float32)
+        self.explained_variance = np.maximum(eigenvalues[order], 0.0)
+        self.total_variance = float(np.maximum(eigenvalues, 0.0).sum())
+
+        return self
+
+    @property
+    def explained_variance_ratio(self):
+        return float(self.explained_variance.sum() / self.total_variance)
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        projected = (x - self.mean) @ self.components.T
+
+        if self.whiten:
+            projected /= np.sqrt(
+                self.explained_variance + self.eps).astype(np.float32)
+
+        return projected
+
+    def transform_matrix(self, matrix, block_size=PROJECTION_BLOCK_SIZE):
+        projected = np.empty((len(matrix), self.n_components),
+                             dtype=np.float32)
+
+        for start in range(0, len(matrix), block_size):
+            block = matrix[start:start + block_size]
+            projected[start:start + len(block)] = self.transform(block)
+
+        return projected
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                params=np.array([self.n_components, int(self.whiten)]),
+                eps=np.array(self.eps),
+                mean=self.mean,
+                components=self.components,
+                explained_variance=self.explained_variance,
+                total_variance=np.array(self.total_variance),
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            n_components, whiten = data['params'].tolist()
+
+            projection = cls(n_components, whiten=bool(whiten),
+                             eps=float(data['eps']))
+            projection.mean = data['mean']
+            projection.components = data['components']
+            projection.explained_variance = data['explained_variance']
+            projection.total_variance = float(data['total_variance'])
+
+        return projection
@@ -0,0 +1,78 @@
+from pymongo import UpdateOne
+
+
+WRITER_FLUSH_SIZE = 1024
+
+
+class RetrievedWriter(object):
+
+    def __init__(self,
+                 image_model,
+                 retrieved_model,
+                 feature_type,
+                 flush_size=WRITER_FLUSH_SIZE):
+        # Buffers the neighbour lists of many query records and persists
+        # them with one insert_many for the retrieved documents and one
+        # bulk_write of $push/$each updates for the query records.
+        self.image_model = image_model
+        self.retrieved_model = retrieved_model
+        self.field_name = 'retrieved_by_' + feature_type
+        self.flush_size = flush_size
+
+        self.db_indices = []
+        self.retrieved = []
+
+    def __len__(self):
+        return len(self.db_indices)
+
+    def clear(self, db_indices):
+        # The retrieved documents belong to a single list each, so they are
+        # deleted with it instead of being left behind as orphans.
+        db_indices = [int(db_index) for db_index in db_indices]
+
+        retrieved_ids = [
+            retrieved_id
+            for record in self.image_model._get_collection().find(
+                {'db_index': {'$in': db_indices}}, {self.field_name: 1})
+            for retrieved_id in record.get(self.field_name, [])
+        ]
+
+        if len(retrieved_ids) > 0:
+            self.retrieved_model.objects(id__in=retrieved_ids).delete()
+
+        self.image_model.objects(
+            db_index__in=db_indices
+        ).update(**{'set__' + self.field_name: []})
+
+    def add(self, db_index, retrieved):
+        self.db_indices.append(int(db_index))
+        self.retrieved.append([
+            self.retrieved_model(**fields).to_mongo().to_dict()
+            for fields in retrieved
+        ])
+
+        if len(self) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self) == 0:
+            return
+
+        documents = [doc for docs in self.retrieved for doc in docs]
+        inserted_ids = self.retrieved_model._get_collection().insert_many(
+            documents, ordered=True).inserted_ids
+
+        updates = []
+        offset = 0
+        for db_index, docs in zip(self.db_indices, self.retrieved):
+            updates.append(UpdateOne(
+                {'db_index': db_index},
+                {'$push': {self.field_name: {
+                    '$each': inserted_ids[offset:offset + len(docs)]}}},
+            ))
+            offset += len(docs)
+
+        self.image_model._get_collection().bulk_write(updates, ordered=False)
+
+        self.db_indices = []
+        self.retrieved = []
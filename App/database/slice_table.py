@@ -0,0 +1,101 @@
+import numpy as np
+
+
+class SliceTable(object):
+
+    def __init__(self, rows):
+        db_indices = np.asarray([r['db_index'] for r in rows], dtype=np.int64)
+        n_rows = int(db_indices.max()) + 1 if len(db_indices) > 0 else 0
+
+        self.patient_ids = sorted(set(r['patient_id'] for r in rows))
+        patient_id_to_idx = {p: i for i, p in enumerate(self.patient_ids)}
+
+        self.db_indices = np.sort(db_indices)
+        self.patient_idx = np.full(n_rows, -1, dtype=np.int32)
+        self.slice_num = np.full(n_rows, -1, dtype=np.int32)
+        self.is_abnormal = np.zeros(n_rows, dtype=bool)
+        self.is_representative = np.zeros(n_rows, dtype=bool)
+
+        self.patient_idx[db_indices] = [
+            patient_id_to_idx[r['patient_id']] for r in rows]
+        self.slice_num[db_indices] = [r['slice_num'] for r in rows]
+        self.is_abnormal[db_indices] = [
+            r.get('is_abnormal', False) for r in rows]
+        self.is_representative[db_indices] = [
+            r.get('is_representative', False) for r in rows]
+
+        self._db_index_lookup = None
+
+    def __len__(self):
+        return len(self.db_indices)
+
+    @property
+    def n_patients(self):
+        return len(self.patient_ids)
+
+    def get_patient_id(self, db_index):
+        return self.patient_ids[self.patient_idx[db_index]]
+
+    def get_patient_idx(self, patient_id):
+        return self.patient_ids.index(patient_id)
+
+    def get_patient_ids(self, db_indices):
+        return [self.patient_ids[i] for i in self.patient_idx[db_indices]]
+
+    def get_db_index(self, patient_id, slice_num):
+        if self._db_index_lookup is None:
+            self._db_index_lookup = {
+                (self.patient_ids[self.patient_idx[db_index]],
+                 int(self.slice_num[db_index])): int(db_index)
+                for db_index in self.db_indices
+            }
+
+        return self._db_index_lookup.get((patient_id, int(slice_num)), -1)
+
+    def get_patient_db_indices(self, patient_idx):
+        return np.flatnonzero(self.patient_idx == patient_idx)
+
+    def _filter(self, db_indices, exclude_patient_idx, exclude_db_index):
+        db_indices = np.asarray(db_indices, dtype=np.int64)
+        keep = db_indices >= 0
+
+        if exclude_db_index is not None:
+            keep &= db_indices != exclude_db_index
+
+        patient_idx = self.patient_idx[np.where(keep, db_indices, 0)]
+
+        if exclude_patient_idx is not None:
+            keep &= patient_idx != exclude_patient_idx
+
+        return np.flatnonzero(keep), patient_idx
+
+    def first_per_patient(self, db_indices, topk=None,
+                          exclude_patient_idx=None, exclude_db_index=None):
+        # Returns the positions in db_indices of the best ranked slice of
+        # each patient, in rank order.
+        positions, patient_idx = self._filter(
+            db_indices, exclude_patient_idx, exclude_db_index)
+
+        _, first = np.unique(patient_idx[positions], return_index=True)
+        positions = positions[np.sort(first)]
+
+        return positions if topk is None else positions[:topk]
+
+    def min_per_patient(self, db_indices, distances, topk=None,
+                        exclude_patient_idx=None, exclude_db_index=None):
+        # Same as first_per_patient for unsorted neighbours: keeps the
+        # closest slice of each patient and ranks patients by its distance.
+        distances = np.asarray(distances)
+        positions, patient_idx = self._filter(
+            db_indices, exclude_patient_idx, exclude_db_index)
+
+        positions = positions[np.lexsort(
+            (distances[positions], patient_idx[positions]))]
+        _, first = np.unique(patient_idx[positions], return_index=True)
+        positions = positions[first]
+
+        if topk is not None and topk < len(positions):
+            positions = positions[
+                np.argpartition(distances[positions], topk - 1)[:topk]]
+
+        return positions[np.argsort(distances[positions], kind='stable')]
@@ -0,0 +1,96 @@
+import os
+import argparse
+
+from app.feature_extractor import FeatureExtractor
+from app.feature_extractor import INFERENCE_MODEL_NAMES
+from app.feature_extractor import export_inference_model
+from app.compiled_encoder import IMAGE_SIZE
+from app.compiled_encoder import PARITY_ATOL
+from app.compiled_encoder import example_input
+from app.compiled_encoder import compile_encoder
+from app.compiled_encoder import load_compiled_encoder
+from app.compiled_encoder import get_compiled_model_path
+from app.compiled_encoder import check_parity
+from utils import read_yaml
+from utils import replace_env_variables_in_config
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+if __name__ == '__main__':
+    config = read_yaml('config.yaml')
+    replace_env_variables_in_config(config)
+
+    parser = argparse.ArgumentParser(
+        description='Export the encoders of a checkpoint for inference.')
+    parser.add_argument('--dataset_type', default='MICCAI_BraTS')
+    parser.add_argument('--model_names', nargs='*', default=None,
+                        help='defaults to every model in config.yaml')
+    parser.add_argument('--backends', nargs='*', default=[],
+                        choices=['torchscript', 'onnx'],
+                        help='also compile the encoders into the '
+                             'compiled_model_dir of the model')
+    parser.add_argument('--image_size', type=int, default=IMAGE_SIZE)
+    parser.add_argument('--n_parity_samples', type=int, default=4)
+    parser.add_argument('--atol', type=float, default=PARITY_ATOL)
+    args = parser.parse_args()
+
+    ds_config = config['dataset_types'][args.dataset_type]
+    model_names = args.model_names or list(ds_config['models'].keys())
+
+    for model_name in model_names:
+        model_config = ds_config['models'][model_name]
+
+        if 'inference_model_path' not in model_config:
+            print('{} has no inference_model_path, skipped.'.format(model_name))
+            continue
+
+        export_inference_model(model_config['saved_model_path'],
+                               model_config['inference_model_path'],
+                               model_config['network_config'])
+
+        print('{}: {:.1f} MB -> {:.1f} MB ({}).'.format(
+            model_name,
+            os.path.getsize(model_config['saved_model_path']) / 2 ** 20,
+            os.path.getsize(model_config['inference_model_path']) / 2 ** 20,
+            model_config['inference_model_path']))
+
+        if len(args.backends) == 0:
+            continue
+
+        feature_extractor = FeatureExtractor(
+            network_config=model_config['network_config'],
+            saved_model_path=model_config['saved_model_path'],
+            inference_model_path=model_config['inference_model_path'],
+        )
+
+        for backend in args.backends:
+            for encoder_name in INFERENCE_MODEL_NAMES:
+                encoder = getattr(feature_extractor, encoder_name)
+                input_dim = \
+                    model_config['network_config'][encoder_name]['input_dim']
+                compiled_model_path = get_compiled_model_path(
+                    model_config['compiled_model_dir'], encoder_name, backend)
+
+                compile_encoder(encoder,
+                                example_input(input_dim, args.image_size),
+                                compiled_model_path, backend)
+
+                # The compiled encoder is compared with the eager one on
+                # inputs it was not traced with.
+                parity = check_parity(
+                    encoder,
+                    load_compiled_encoder(compiled_model_path, backend),
+                    [example_input(input_dim, args.image_size, seed=seed + 1)
+                     for seed in range(args.n_parity_samples)],
+                    atol=args.atol)
+
+                print('{} {} {}: max abs diff {:.2e}, max rel diff {:.2e}.'
+                      .format(model_name, backend, encoder_name,
+                              parity['max_abs_diff'], parity['max_rel_diff']))
+
+                if not parity['passed']:
+                    os.remove(compiled_model_path)
+                    raise Exception(
+                        '{} {} does not match the eager encoder.'.format(
+                            backend, encoder_name))
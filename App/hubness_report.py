@@ -0,0 +1,77 @@
+import os
+import json
+import argparse
+
+from database import DatabaseManager
+from utils import read_yaml
+from utils import replace_env_variables_in_config
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+if __name__ == '__main__':
+    config = read_yaml('config.yaml')
+    replace_env_variables_in_config(config)
+
+    parser = argparse.ArgumentParser(
+        description='Hubness and reverse-kNN diagnostics of the retrieval index.')
+    parser.add_argument('--dataset_type', default='MICCAI_BraTS')
+    parser.add_argument('--model_names', nargs='*', default=None,
+                        help='defaults to every model in config.yaml')
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--n_hubs', type=int, default=20)
+    parser.add_argument('--output', default='hubness_report.json')
+    args = parser.parse_args()
+
+    ds_config = config['dataset_types'][args.dataset_type]
+    model_names = args.model_names or list(ds_config['models'].keys())
+
+    reports = []
+    for model_name in model_names:
+        model_config = ds_config['models'].get(model_name, {})
+
+        database_manager = DatabaseManager(
+            project_name=config['mongodb']['project_name'],
+            dataset_name=ds_config['dataset_name'],
+            annoy_model_path=config['annoy']['annoy_model_path'],
+            slice_root_dir_path=config['mongodb']['slice_root_dir_path'],
+            nifti_root_dir_path=config['mongodb']['nifti_root_dir_path'],
+            code_root_dir_path=config['mongodb']['code_root_dir_path'],
+            model_name=model_name,
+            n_trees=config['annoy']['n_trees'],
+            n_jobs=config['annoy'].get('n_jobs', -1),
+            on_disk_build=config['annoy'].get('on_disk_build', False),
+            background_rebuild=False,
+            index_type=config['annoy'].get('index_type', 'annoy'),
+            pq_n_subvectors=config['annoy'].get('pq_n_subvectors', 64),
+            pq_use_opq=config['annoy'].get('pq_use_opq', False),
+            pq_n_rerank=config['annoy'].get('pq_n_rerank', 100),
+            projection_dim=config['annoy'].get('projection_dim'),
+            projection_whiten=config['annoy'].get('projection_whiten', False),
+            hnsw_m=config['annoy'].get('hnsw_m', 16),
+            hnsw_ef_construction=config['annoy'].get('hnsw_ef_construction', 200),
+            hnsw_ef_search=config['annoy'].get('hnsw_ef_search', 100),
+            vector_length=model_config.get('vector_length'),
+            verify_code_files=config['mongodb'].get('verify_code_files', False),
+            alias=config['mongodb']['alias'],
+            host=config['mongodb']['host'],
+        )
+
+        report = database_manager.hubness_report(
+            topk=args.topk, n_hubs=args.n_hubs)
+        reports.append(report)
+
+        print('{}: skewness {:.2f}, max k-occurrence {}, antihubs {:.1%}, '
+              'covered patients {:.1%}, slices short of top-{}: {}'.format(
+                  model_name,
+                  report['k_occurrence']['skewness'],
+                  report['k_occurrence']['max'],
+                  report['antihub_rate'],
+                  report['patient_coverage']['covered_patient_rate'],
+                  args.topk,
+                  report['n_short_rows']))
+
+    with open(args.output, 'w') as f:
+        json.dump(reports, f, indent=2)
+
+    print('Saved the report to {}.'.format(args.output))
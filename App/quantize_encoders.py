@@ -0,0 +1,134 @@
+import os
+import json
+import pathlib
+import argparse
+
+from app.feature_extractor import FeatureExtractor
+from app.feature_extractor import INFERENCE_MODEL_NAMES
+from app.quantization import quantize_int8
+from app.quantization import save_int8_encoder
+from app.quantization import save_fp16_state_dict
+from app.quantization import get_quantized_model_path
+from app.quantization import sample_slices
+from app.quantization import get_calibration_inputs
+from app.quantization import evaluate_quantization
+from database.benchmark import load_code_matrix
+from database.code_store import CODE_STORE_DIR_NAME
+from utils import read_yaml
+from utils import replace_env_variables_in_config
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+if __name__ == '__main__':
+    config = read_yaml('config.yaml')
+    replace_env_variables_in_config(config)
+
+    parser = argparse.ArgumentParser(
+        description='Post-training quantization of the query encoders.')
+    parser.add_argument('--dataset_type', default='MICCAI_BraTS')
+    parser.add_argument('--model_names', nargs='*', default=None,
+                        help='defaults to every model in config.yaml')
+    parser.add_argument('--modes', nargs='*', default=['int8'],
+                        choices=['int8', 'fp16_weights'])
+    parser.add_argument('--n_calibration', type=int, default=64)
+    parser.add_argument('--n_evaluation', type=int, default=32)
+    parser.add_argument('--topk', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='quantization_report.json')
+    args = parser.parse_args()
+
+    ds_config = config['dataset_types'][args.dataset_type]
+    model_names = args.model_names or list(ds_config['models'].keys())
+
+    # Calibration and evaluation slices are drawn together, so they never
+    # overlap.
+    samples = sample_slices(ds_config['template']['slice_root_dir_path'],
+                            ds_config['template']['modalities'],
+                            args.n_calibration + args.n_evaluation,
+                            seed=args.seed)
+    calibration_samples = samples[:args.n_calibration]
+    evaluation_samples = samples[args.n_calibration:]
+
+    reports = []
+    for model_name in model_names:
+        model_config = ds_config['models'][model_name]
+
+        reference_extractor = FeatureExtractor(
+            network_config=model_config['network_config'],
+            saved_model_path=model_config['saved_model_path'],
+            inference_model_path=model_config.get('inference_model_path'),
+        )
+
+        store_dir_path = pathlib.Path(
+            config['mongodb']['code_root_dir_path']) \
+            / ds_config['dataset_name'] \
+            / model_name \
+            / CODE_STORE_DIR_NAME
+
+        reference_matrix = None
+        if os.path.exists(store_dir_path):
+            reference_matrix = load_code_matrix(store_dir_path, 'eac')
+
+        calibration_inputs = get_calibration_inputs(
+            reference_extractor, calibration_samples)
+
+        for mode in args.modes:
+            print('Quantizing {} to {}.'.format(model_name, mode))
+
+            file_bytes = 0
+            for encoder_name in INFERENCE_MODEL_NAMES:
+                encoder = getattr(reference_extractor, encoder_name)
+                path = get_quantized_model_path(
+                    model_config['compiled_model_dir'], encoder_name, mode)
+
+                if mode == 'int8':
+                    save_int8_encoder(
+                        quantize_int8(encoder,
+                                      calibration_inputs[encoder_name]),
+                        calibration_inputs[encoder_name][0], path)
+
+                else:
+                    save_fp16_state_dict(encoder, path)
+
+                file_bytes += os.path.getsize(path)
+
+            quantized_extractor = FeatureExtractor(
+                network_config=model_config['network_config'],
+                saved_model_path=model_config['saved_model_path'],
+                inference_model_path=model_config.get('inference_model_path'),
+                compiled_model_dir=model_config['compiled_model_dir'],
+                quantization=mode,
+            )
+
+            # fp16_weights only shrinks the files, its encoders still run
+            # in float32.
+            report = evaluate_quantization(
+                reference_extractor, quantized_extractor, evaluation_samples,
+                reference_matrix=reference_matrix, topk=args.topk,
+                measure_latency=mode != 'fp16_weights')
+            report.update({'model_name': model_name, 'quantization': mode,
+                           'file_bytes': file_bytes})
+            reports.append(report)
+
+            print('{} {}: relative L2 drift eac {:.2%}, nac {:.2%}, '
+                  'aac {:.2%}; {:.1f} MB of encoders.'.format(
+                      model_name, mode,
+                      report['drift']['eac']['mean_relative_l2'],
+                      report['drift']['nac']['mean_relative_l2'],
+                      report['drift']['aac']['mean_relative_l2'],
+                      file_bytes / 2 ** 20))
+
+            if 'latency_ms' in report:
+                print('{:.0f} ms -> {:.0f} ms per query.'.format(
+                    report['latency_ms']['reference'],
+                    report['latency_ms']['quantized']))
+
+            if 'topk_overlap' in report:
+                print('Top-{} neighbour overlap with float32: {:.1%}.'.format(
+                    args.topk, report['topk_overlap']))
+
+    with open(args.output, 'w') as f:
+        json.dump(reports, f, indent=2)
+
+    print('Saved the report to {}.'.format(args.output))
@@ -14,6 +14,7 @@ import functions.pytorch_ssim as pytorch_ssim
 from dataio import get_data_loader
 from utils import minmax_norm
 from utils import to_cpu
+from utils import CodeStoreWriter
 
 
 MORPHO_KERNEL = 15
@@ -474,6 +475,29 @@ class DecompTrainerBase(pl.LightningModule):
         aac = out['aac'].cpu().numpy()
         eac = out['eac'].cpu().numpy()
 
+        code_format = getattr_else_none(self.config.save, 'code_format') or 'slices'
+        assert code_format in {'slices', 'store', 'both'}
+
+        if code_format in {'store', 'both'}:
+            if getattr(self, 'code_store_writer', None) is None:
+                # A distinct prefix keeps the shards of later runs (e.g. of
+                # newly ingested patients) from overwriting earlier ones.
+                shard_prefix = getattr_else_none(
+                    self.config.save, 'code_shard_prefix') or 'rank'
+                self.code_store_writer = CodeStoreWriter(
+                    self.test_save_dir_path,
+                    shard_name=shard_prefix + '-' + str(self.global_rank),
+                )
+
+            self.code_store_writer.append(
+                patient_ids,
+                [int(n_slice.item()) for n_slice in n_slices],
+                {'nac': nac, 'aac': aac, 'eac': eac},
+            )
+
+        if code_format == 'store':
+            return
+
         for i, patient_id in enumerate(patient_ids):
             n_slice = int(n_slices[i].item())
 
@@ -501,4 +525,8 @@ class DecompTrainerBase(pl.LightningModule):
             ), _eac)
 
     def test_epoch_end(self, outputs):
+        if getattr(self, 'code_store_writer', None) is not None:
+            self.code_store_writer.close()
+            self.code_store_writer = None
+
         return self.global_rank
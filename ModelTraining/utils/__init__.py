@@ -1,2 +1,3 @@
 from .util import *
 from .logger import Logger, ModelSaver
+from .code_store import CodeStoreWriter
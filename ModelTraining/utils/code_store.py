@@ -0,0 +1,66 @@
+import os
+import json
+import numpy as np
+
+
+CODE_TYPES = ('eac', 'nac', 'aac')
+CODE_STORE_DIR_NAME = 'code_store'
+
+
+class CodeStoreWriter(object):
+
+    def __init__(self, save_dir_path, shard_name='rank-0', code_types=CODE_TYPES):
+        self.save_dir_path = os.path.join(save_dir_path, CODE_STORE_DIR_NAME)
+        self.shard_name = shard_name
+        self.code_types = code_types
+
+        self.patient_ids = []
+        self.slice_nums = []
+        self.codes = {code_type: [] for code_type in self.code_types}
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def append(self, patient_ids, slice_nums, codes):
+        n_rows = len(patient_ids)
+
+        for code_type in self.code_types:
+            code = np.asarray(codes[code_type], dtype=np.float32)
+            self.codes[code_type].append(code.reshape(n_rows, -1))
+
+        self.patient_ids.extend(str(patient_id) for patient_id in patient_ids)
+        self.slice_nums.extend(int(slice_num) for slice_num in slice_nums)
+
+    def close(self):
+        if len(self) == 0:
+            return
+
+        os.makedirs(self.save_dir_path, exist_ok=True)
+
+        vector_lengths = {}
+        for code_type in self.code_types:
+            matrix = np.ascontiguousarray(
+                np.concatenate(self.codes[code_type], axis=0))
+            vector_lengths[code_type] = int(matrix.shape[1])
+
+            np.save(os.path.join(
+                self.save_dir_path, code_type + '-' + self.shard_name + '.npy'
+            ), matrix)
+
+        manifest = {
+            'shard_name': self.shard_name,
+            'dtype': 'float32',
+            'n_rows': len(self),
+            'vector_lengths': vector_lengths,
+            'patient_ids': self.patient_ids,
+            'slice_nums': self.slice_nums,
+        }
+
+        with open(os.path.join(
+                self.save_dir_path,
+                'manifest-' + self.shard_name + '.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        self.patient_ids = []
+        self.slice_nums = []
+        self.codes = {code_type: [] for code_type in self.code_types}